@@ -4,3 +4,5 @@ __short_version__ = '.'.join(__version_info__)
 __author__ = 'Stormpath, Inc.'
 __license__ = 'Apache'
 __copyright__ = '(c) 2012 - 2015 Stormpath, Inc.'
+
+default_app_config = 'django_stormpath.apps.StormpathConfig'
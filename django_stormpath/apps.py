@@ -0,0 +1,11 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class StormpathConfig(AppConfig):
+    name = 'django_stormpath'
+
+    def ready(self):
+        if getattr(settings, 'STORMPATH_LAST_LOGIN_FLUSH_INTERVAL', None):
+            from .last_login import install
+            install()
@@ -1,19 +1,29 @@
 from logging import getLogger
 
+from django.conf import settings
+from django.core.cache import cache
 from django.contrib.auth import get_user_model
-from django.db.models import Q
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import Group
 from stormpath.error import Error
 
+from . import tenants
+from .permissions import PERMISSIONS_CACHE_TIMEOUT, get_permissions_cache_key
+from .tasks import schedule_refresh
+from .throttling import get_client_ip, get_login_throttle
+from .tokens import validate_access_token
+
 
 log = getLogger(__name__)
 
 
+def _refreshed_key(user):
+    return 'stormpath:refreshed:%s' % user.pk
+
+
 def get_application():
-    """Helper function. Needed for easier testing"""
-    from .models import APPLICATION
-    return APPLICATION
+    """Return the Stormpath application of the current tenant."""
+    return tenants.get_application()
 
 
 class StormpathBackend(ModelBackend):
@@ -35,6 +45,41 @@ class StormpathBackend(ModelBackend):
             log.debug(e)
             return None
 
+    def _throttled_authenticate(self, throttle, username, password, ip):
+        """Like :meth:`_stormpath_authenticate`, but throttled locally."""
+        if not throttle.check(username, password, ip):
+            return None
+
+        APPLICATION = get_application()
+        try:
+            result = APPLICATION.authenticate_account(username, password)
+        except Error as e:
+            log.debug(e)
+            # Only count rejected credentials, not outages.
+            if e.status == 400:
+                throttle.failed(username, password, ip)
+            return None
+
+        throttle.succeeded(username)
+        return result.account
+
+    def get_all_permissions(self, user_obj, obj=None):
+        """Serve the user's permission set from the shared cache.
+
+        Django only caches it on the user instance, which doesn't survive the
+        request.  See :mod:`django_stormpath.permissions`.
+        """
+        if (obj is None and user_obj.is_active and user_obj.pk is not None and
+                not hasattr(user_obj, '_perm_cache')):
+            key = get_permissions_cache_key(user_obj.pk, user_obj.is_superuser)
+            perms = cache.get(key)
+            if perms is None:
+                perms = super(StormpathBackend, self).get_all_permissions(user_obj)
+                cache.set(key, perms, PERMISSIONS_CACHE_TIMEOUT)
+            user_obj._perm_cache = perms
+
+        return super(StormpathBackend, self).get_all_permissions(user_obj, obj)
+
     def _get_group_difference(self, sp_groups):
         """Helper method for gettings the groups that
         are present in the local db but not on stormpath
@@ -49,7 +94,7 @@ class StormpathBackend(ModelBackend):
         """Helper method for saving to the local db groups
         that are missing but are on Stormpath"""
         APPLICATION = get_application()
-        sp_groups = [g.name for g in APPLICATION.groups]
+        sp_groups = [tenants.local_group_name(g.name, APPLICATION) for g in APPLICATION.groups]
         missing_from_db, missing_from_sp = self._get_group_difference(sp_groups)
 
         if missing_from_db:
@@ -60,24 +105,80 @@ class StormpathBackend(ModelBackend):
 
             Group.objects.bulk_create(groups_to_create)
 
+    def _get_fresh_enough_user(self, account):
+        """Return the already mirrored local user for ``account`` or None.
+
+        Only used when ``STORMPATH_PROFILE_REFRESH_WINDOW`` is set.  The user
+        is looked up by href so the account doesn't have to be fetched, and if
+        it wasn't refreshed within the window a refresh is scheduled in the
+        background.
+        """
+        UserModel = get_user_model()
+        user = UserModel.objects.filter(href=account.href).first()
+        if user is None:
+            return None
+
+        window = settings.STORMPATH_PROFILE_REFRESH_WINDOW
+        if cache.add(_refreshed_key(user), True, window):
+            schedule_refresh(account.href)
+
+        return user
+
     def _create_or_get_user(self, account):
+        window = getattr(settings, 'STORMPATH_PROFILE_REFRESH_WINDOW', None)
+        if window is None:
+            return self._mirror_user(account)
+
+        user = self._get_fresh_enough_user(account)
+        if user is None:
+            user = self._mirror_user(account)
+            if user is not None:
+                cache.set(_refreshed_key(user), True, window)
+
+        return user
+
+    def _get_user_for_account(self, account):
+        """Return the local user mirroring ``account``.
+
+        Users are identified by their (unique, indexed) href.  Rows mirrored
+        before hrefs were tracked are matched by email instead; rows bound to
+        another account never are.  Raises ``DoesNotExist`` if there is no
+        such user.
+        """
+        UserModel = get_user_model()
+        try:
+            return UserModel.objects.get(href=account.href)
+        except UserModel.DoesNotExist:
+            return UserModel.objects.get(email=account.email, href__isnull=True)
+
+    def _mirror_user(self, account):
+        """Create or update the local user (and its groups) from ``account``.
+
+        Returns None if the account's email belongs to the user of another
+        account (say, of another tenant), which is left alone.
+        """
         UserModel = get_user_model()
 
         try:
-            user = UserModel.objects.get(Q(username=account.username) | Q(email=account.email))
+            user = self._get_user_for_account(account)
             user._mirror_data_from_stormpath_account(account)
             self._mirror_groups_from_stormpath()
-            users_sp_groups = [g.name for g in account.groups]
+            users_sp_groups = [tenants.local_group_name(g.name) for g in account.groups]
             user.groups = Group.objects.filter(name__in=users_sp_groups)
             user._save_db_only()
 
             return user
         except UserModel.DoesNotExist:
+            if UserModel.objects.filter(email=account.email).exists():
+                log.warning('Not mirroring account %s, its email belongs to '
+                    'the user of another account.', account.href)
+                return None
+
             user = UserModel()
             user._mirror_data_from_stormpath_account(account)
             self._mirror_groups_from_stormpath()
             user._save_db_only()
-            users_sp_groups = [g.name for g in account.groups]
+            users_sp_groups = [tenants.local_group_name(g.name) for g in account.groups]
             user.groups = Group.objects.filter(name__in=users_sp_groups)
             user._save_db_only()
 
@@ -99,7 +200,16 @@ class StormpathBackend(ModelBackend):
             UserModel = get_user_model()
             username = kwargs.get(UserModel.USERNAME_FIELD)
 
-        account = self._stormpath_authenticate(username, password)
+        # Not meant for us (e.g. token credentials), don't ask Stormpath.
+        if username is None or password is None:
+            return None
+
+        throttle = get_login_throttle()
+        if throttle is None:
+            account = self._stormpath_authenticate(username, password)
+        else:
+            account = self._throttled_authenticate(throttle, username, password,
+                get_client_ip(kwargs.get('request')))
         if account is None:
             return None
 
@@ -119,3 +229,27 @@ class StormpathIdSiteBackend(StormpathBackend):
 class StormpathSocialBackend(StormpathIdSiteBackend):
     """Used for authenticating with GOOGLE/FACEBOOK/others"""
     pass
+
+
+class StormpathAccessTokenBackend(StormpathBackend):
+    """Used for authenticating API requests with Stormpath access tokens.
+
+    Tokens are validated locally by signature and expiry, and the account
+    href they carry is mapped to the local user, so no remote calls are made.
+    Users have to be mirrored locally already (e.g. by logging in once).
+    """
+
+    def authenticate(self, access_token=None, **kwargs):
+        if access_token is None:
+            return None
+
+        claims = validate_access_token(access_token, get_application().href)
+        if claims is None:
+            return None
+
+        # href is unique, so this is a single indexed query.
+        user = get_user_model()._default_manager.filter(href=claims['sub']).first()
+        if user is None or not user.is_active:
+            return None
+
+        return user
@@ -0,0 +1,353 @@
+"""Instrumentation for the Stormpath HTTP client.
+
+Every remote call made by the Stormpath SDK goes through the ``HttpExecutor``
+attached to the client's data store.  We wrap that executor so the package can
+observe and shape the traffic it generates -- for instance to count round trips
+in tests, to fetch each resource at most once per request, to share one GET
+between threads asking for the same resource, or to retry calls that were
+throttled.  Cached resources never reach the executor, so only real
+HTTP calls are seen.
+"""
+
+from contextlib import contextmanager
+from copy import deepcopy
+from random import uniform
+from threading import Event, local, Lock
+from time import sleep, time
+
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.http import parse_http_date_safe
+
+from requests.exceptions import RequestException
+from stormpath.error import Error as StormpathError
+
+from .ratelimit import acquire
+
+
+# Sent after every HTTP call made to the Stormpath API, whether it succeeded
+# or not.  ``status`` is ``None`` for successful calls.
+remote_call = Signal(providing_args=['method', 'url', 'params', 'status'])
+
+# Sent before a failed call is retried.  ``status`` is ``None`` for connection
+# errors and ``attempt`` counts from 1.
+remote_retry = Signal(providing_args=['method', 'url', 'status', 'attempt', 'delay'])
+
+_local = local()
+
+_stats_lock = Lock()
+retry_stats = {'retries': 0, 'exhausted': 0}
+
+
+def _count(stat):
+    with _stats_lock:
+        retry_stats[stat] += 1
+
+
+def get_retry_stats():
+    """Return how many calls were retried, and how many still failed.
+
+    The counters are per process and never reset, so they can be exported as
+    metrics as they are.
+    """
+    with _stats_lock:
+        return dict(retry_stats)
+
+
+@contextmanager
+def idempotent():
+    """Mark the calls made in the block as safe to repeat.
+
+    POSTs are retried after server and connection errors only in such a
+    block, because the first attempt may have been applied already.  Use it
+    for writes that end up in the same state when repeated, like updating an
+    account with a full set of properties.
+    """
+    _local.idempotent = getattr(_local, 'idempotent', 0) + 1
+    try:
+        yield
+    finally:
+        _local.idempotent -= 1
+
+
+def _in_idempotent_block():
+    return getattr(_local, 'idempotent', 0) > 0
+
+
+class RetryPolicy(object):
+    """Decides whether and when a failed Stormpath call is retried.
+
+    Throttled calls (429) were never applied, so they are always retried.
+    Server (5xx) and connection errors are retried for idempotent calls only:
+    GETs, DELETEs and calls made in an :func:`idempotent` block.  The delay is
+    the ``Retry-After`` the API asked for or, if it didn't, an exponential
+    backoff with full jitter, capped at ``max_delay`` seconds.
+    """
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'DELETE')
+
+    def __init__(self, max_retries=4, base_delay=0.5, max_delay=30,
+            retry_statuses=(500, 502, 503, 504)):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = retry_statuses
+
+    def should_retry(self, method, status, attempt):
+        if attempt > self.max_retries:
+            return False
+
+        if status == 429:
+            return True
+
+        if status is None or status in self.retry_statuses:
+            return method.upper() in self.IDEMPOTENT_METHODS or _in_idempotent_block()
+
+        return False
+
+    def get_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(max(retry_after, 0), self.max_delay)
+
+        return uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def wait(self, delay):
+        sleep(delay)
+
+
+def get_retry_policy():
+    """Build the retry policy from ``STORMPATH_RETRY_POLICY``.
+
+    The setting is a dict of :class:`RetryPolicy` arguments; ``None`` turns
+    retries off.
+    """
+    options = getattr(settings, 'STORMPATH_RETRY_POLICY', {})
+    if options is None:
+        return RetryPolicy(max_retries=0)
+
+    return RetryPolicy(**options)
+
+
+def _remember_retry_after(response, *args, **kwargs):
+    """Response hook keeping the ``Retry-After`` of the last response."""
+    _local.retry_after = response.headers.get('Retry-After')
+
+
+def _pop_retry_after():
+    value = getattr(_local, 'retry_after', None)
+    _local.retry_after = None
+    if not value:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    # Retry-After may also be an HTTP date.
+    timestamp = parse_http_date_safe(value)
+    if timestamp is None:
+        return None
+
+    return timestamp - time()
+
+
+def activate_identity_map():
+    """Start memoizing GET responses for the current thread.
+
+    Until :func:`deactivate_identity_map` is called every resource (keyed by
+    its href and query) is fetched at most once.  Any write to Stormpath
+    discards everything memoized so far, so we never serve stale data after
+    our own changes.
+    """
+    _local.identity_map = {}
+
+
+def deactivate_identity_map():
+    """Stop memoizing and discard everything fetched so far."""
+    _local.identity_map = None
+
+
+@contextmanager
+def identity_map():
+    """Memoize GET responses for the duration of the block.
+
+    Nested blocks share the outer identity map.
+    """
+    previous = getattr(_local, 'identity_map', None)
+    if previous is None:
+        activate_identity_map()
+    try:
+        yield
+    finally:
+        _local.identity_map = previous
+
+
+class _Flight(object):
+    """A GET in progress, which other threads can wait for."""
+
+    def __init__(self):
+        self.done = Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+
+_flights = {}
+_flights_lock = Lock()
+
+# Bumped by every write, so GETs made after a write don't join flights that
+# started before it and could return what the write changed.
+_generation = [0]
+
+
+def _bump_generation():
+    with _flights_lock:
+        _generation[0] += 1
+
+
+def _get_identity_map():
+    return getattr(_local, 'identity_map', None)
+
+
+def _resource_key(url, params):
+    if not params:
+        return url
+    return '%s?%r' % (url, sorted(params.items()))
+
+
+class StormpathExecutor(object):
+    """Proxy around the SDK ``HttpExecutor``.
+
+    Anything we don't intercept is delegated to the wrapped executor, so the
+    SDK keeps working exactly as before.
+    """
+
+    def __init__(self, executor, retry_policy=None):
+        self.executor = executor
+        self.retry_policy = retry_policy
+
+    def __getattr__(self, name):
+        return getattr(self.executor, name)
+
+    def _call(self, method, url, params, func, *args, **kwargs):
+        policy = self.retry_policy or get_retry_policy()
+        attempt = 0
+        while True:
+            _local.retry_after = None
+            try:
+                return self._attempt(method, url, params, func, *args, **kwargs)
+            except (StormpathError, RequestException) as e:
+                status = getattr(e, 'status', None)
+                attempt += 1
+                if not policy.should_retry(method, status, attempt):
+                    if attempt > 1:
+                        _count('exhausted')
+                    raise
+
+            delay = policy.get_delay(attempt, _pop_retry_after())
+            _count('retries')
+            remote_retry.send(sender=self.__class__, method=method, url=url,
+                status=status, attempt=attempt, delay=delay)
+            policy.wait(delay)
+
+    def _attempt(self, method, url, params, func, *args, **kwargs):
+        acquire()
+        status = None
+        try:
+            return func(*args, **kwargs)
+        except StormpathError as e:
+            status = e.status
+            raise
+        finally:
+            remote_call.send(sender=self.__class__, method=method, url=url,
+                params=params, status=status)
+
+    def _write(self, method, url, params, func, *args, **kwargs):
+        resources = _get_identity_map()
+        if resources:
+            resources.clear()
+        _bump_generation()
+
+        return self._call(method, url, params, func, *args, **kwargs)
+
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() != 'GET':
+            return self._write(method, url, kwargs.get('params'),
+                self.executor.request, method, url, *args, **kwargs)
+
+        return self._call(method, url, kwargs.get('params'),
+            self.executor.request, method, url, *args, **kwargs)
+
+    def _fetch(self, url, params):
+        """GET ``url``, sharing the response with concurrent identical GETs.
+
+        The first thread to ask for a resource makes the call, and threads
+        asking for it while the call is in flight wait for it and get a copy
+        of its response (or its error) instead of making their own.
+        """
+        with _flights_lock:
+            key = (_generation[0], _resource_key(url, params))
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = _Flight()
+            else:
+                flight.followers += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return deepcopy(flight.result)
+
+        result = None
+        try:
+            result = self._call('GET', url, params,
+                self.executor.get, url, params=params)
+            return result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with _flights_lock:
+                del _flights[key]
+            # Nobody can join anymore, so only copy if somebody did.
+            if flight.followers:
+                flight.result = deepcopy(result)
+            flight.done.set()
+
+    def get(self, url, params=None):
+        resources = _get_identity_map()
+        if resources is None:
+            return self._fetch(url, params)
+
+        key = _resource_key(url, params)
+        if key not in resources:
+            resources[key] = self._fetch(url, params)
+
+        # Callers get their own copy so they can't corrupt the memoized one.
+        return deepcopy(resources[key])
+
+    def post(self, url, *args, **kwargs):
+        return self._write('POST', url, kwargs.get('params'),
+            self.executor.post, url, *args, **kwargs)
+
+    def delete(self, url, *args, **kwargs):
+        return self._write('DELETE', url, kwargs.get('params'),
+            self.executor.delete, url, *args, **kwargs)
+
+
+def install_executor(client):
+    """Wrap the executor of ``client`` with a :class:`StormpathExecutor`.
+
+    Installing twice is harmless; the already wrapped executor is returned.
+    """
+    store = client.data_store
+    if not isinstance(store.executor, StormpathExecutor):
+        session = getattr(store.executor, 'session', None)
+        if session is not None:
+            session.hooks.setdefault('response', []).append(_remember_retry_after)
+        store.executor = StormpathExecutor(store.executor)
+
+    return store.executor
@@ -0,0 +1,124 @@
+"""Process-wide cache of the policies of Stormpath directories.
+
+Whether a new account has to verify its email, how strong its password must
+be and which provider it comes from depend on the directory the account lives
+in, not on the application.  Looking those up means fetching the directory
+and its policies, so they're cached here by directory href for
+``STORMPATH_DIRECTORY_CACHE_TIMEOUT`` seconds (5 minutes by default), and
+mirroring accounts from many directories fetches each directory's policies
+once.
+"""
+
+from threading import Lock
+from time import time
+
+from django.conf import settings
+
+from stormpath.resources import AccountCreationPolicy
+
+from .tenants import get_application
+
+
+DEFAULT_TIMEOUT = 5 * 60
+
+_lock = Lock()
+
+# Directory href -> (expiry, DirectoryPolicy).
+_policies = {}
+
+# Application href -> (expiry, href of its default directory).
+_default_directories = {}
+
+
+class DirectoryPolicy(object):
+    """The policies of a directory that matter for mirroring accounts."""
+
+    def __init__(self, directory):
+        self.href = directory.href
+
+        status = directory.account_creation_policy.verification_email_status
+        self.verification_required = status != AccountCreationPolicy.EMAIL_STATUS_DISABLED
+
+        # Load the strength now, so validating doesn't fetch it.
+        self.password_strength = directory.password_policy.strength
+        self.password_strength.min_length
+
+        try:
+            self.provider_id = directory.provider.provider_id
+        except AttributeError:
+            self.provider_id = None
+
+    @property
+    def is_active_by_default(self):
+        """New accounts are enabled right away unless they have to verify."""
+        return not self.verification_required
+
+    def validate_password(self, password):
+        """Raise ``ValueError`` unless ``password`` is strong enough."""
+        self.password_strength.validate_password(password)
+
+
+def _get_timeout():
+    return getattr(settings, 'STORMPATH_DIRECTORY_CACHE_TIMEOUT', DEFAULT_TIMEOUT)
+
+
+def _cached(cache, key, load):
+    now = time()
+    with _lock:
+        entry = cache.get(key)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    # Loaded outside the lock: at worst two threads load the same directory.
+    value = load()
+    with _lock:
+        cache[key] = (now + _get_timeout(), value)
+    return value
+
+
+def _get_default_directory_href(application):
+    def load():
+        store = application.default_account_store_mapping.account_store
+        # The default account store can be a group of a directory.
+        return getattr(store, 'directory', store).href
+
+    return _cached(_default_directories, application.href, load)
+
+
+def get_directory_policy(href=None):
+    """Return the :class:`DirectoryPolicy` of the directory at ``href``.
+
+    Without an href, the policy of the default account store of the current
+    tenant's application, where new accounts are created, is returned.
+    """
+    from .models import CLIENT
+
+    if href is None:
+        href = _get_default_directory_href(get_application())
+
+    return _cached(_policies, href,
+        lambda: DirectoryPolicy(CLIENT.directories.get(href)))
+
+
+def get_account_directory_href(account):
+    """Return the href of the directory of ``account``, or None if unknown.
+
+    ``account`` is an SDK account or an ``AccountRecord``.  The href is part of
+    the account's properties, so nothing is fetched.
+    """
+    try:
+        return account.directory.href
+    except AttributeError:
+        return None
+
+
+def get_account_policy(account):
+    """Return the :class:`DirectoryPolicy` of the directory of ``account``."""
+    return get_directory_policy(get_account_directory_href(account))
+
+
+def clear_directory_policies():
+    """Forget all cached policies, e.g. after changing a directory's."""
+    with _lock:
+        _policies.clear()
+        _default_directories.clear()
@@ -0,0 +1,38 @@
+"""Django REST framework integration.
+
+Requires ``djangorestframework`` to be installed::
+
+    REST_FRAMEWORK = {
+        'DEFAULT_AUTHENTICATION_CLASSES': (
+            'django_stormpath.drf.StormpathAccessTokenAuthentication',
+        ),
+    }
+"""
+
+from rest_framework import exceptions
+from rest_framework.authentication import BaseAuthentication
+
+from .backends import StormpathAccessTokenBackend
+from .tokens import get_bearer_token
+
+
+class StormpathAccessTokenAuthentication(BaseAuthentication):
+    """Authenticate API requests with a Stormpath access token.
+
+    Tokens are validated locally, so authenticated requests don't need any
+    calls to Stormpath.
+    """
+
+    def authenticate(self, request):
+        token = get_bearer_token(request)
+        if token is None:
+            return None
+
+        user = StormpathAccessTokenBackend().authenticate(access_token=token)
+        if user is None:
+            raise exceptions.AuthenticationFailed('Invalid or expired access token.')
+
+        return (user, token)
+
+    def authenticate_header(self, request):
+        return 'Bearer realm="api"'
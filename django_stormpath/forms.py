@@ -7,7 +7,8 @@ from django.contrib.auth.forms import ReadOnlyPasswordHashField
 
 from stormpath.error import Error
 
-from .models import APPLICATION
+from .directories import get_directory_policy
+from .tenants import get_application
 
 
 class StormpathUserCreationForm(forms.ModelForm):
@@ -29,8 +30,7 @@ class StormpathUserCreationForm(forms.ModelForm):
         password2 = self.cleaned_data.get('password2')
 
         try:
-            directory = APPLICATION.default_account_store_mapping.account_store
-            directory.password_policy.strength.validate_password(password2)
+            get_directory_policy().validate_password(password2)
         except ValueError as e:
             raise forms.ValidationError(str(e))
 
@@ -48,7 +48,7 @@ class StormpathUserCreationForm(forms.ModelForm):
         delete ther user on save to keep in sync with Stormpath.
         """
         try:
-            accounts = APPLICATION.accounts.search({'username': self.cleaned_data['username']})
+            accounts = get_application().accounts.search({'username': self.cleaned_data['username']})
             if len(accounts):
                 msg = "User with that username already exists."
                 raise forms.ValidationError(msg)
@@ -64,7 +64,7 @@ class StormpathUserCreationForm(forms.ModelForm):
         The username is only unique within a Stormpath application.
         """
         try:
-            accounts = APPLICATION.accounts.search({'email': self.cleaned_data['email']})
+            accounts = get_application().accounts.search({'email': self.cleaned_data['email']})
             if len(accounts):
                 msg = 'User with that email already exists.'
                 raise forms.ValidationError(msg)
@@ -106,7 +106,7 @@ class PasswordResetEmailForm(forms.Form):
             raise forms.ValidationError('Please provide an email address.')
 
     def save(self):
-        APPLICATION.send_password_reset_email(self.cleaned_data['email'])
+        get_application().send_password_reset_email(self.cleaned_data['email'])
 
 
 class PasswordResetForm(forms.Form):
@@ -121,8 +121,7 @@ class PasswordResetForm(forms.Form):
         password2 = self.cleaned_data.get('new_password2')
 
         try:
-            directory = APPLICATION.default_account_store_mapping.account_store
-            directory.password_policy.strength.validate_password(password2)
+            get_directory_policy().validate_password(password2)
         except ValueError as e:
             raise forms.ValidationError(str(e))
 
@@ -133,4 +132,4 @@ class PasswordResetForm(forms.Form):
         return password2
 
     def save(self, token):
-        APPLICATION.reset_account_password(token, self.cleaned_data['new_password1'])
+        get_application().reset_account_password(token, self.cleaned_data['new_password1'])
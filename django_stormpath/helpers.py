@@ -14,3 +14,33 @@ def validate_settings(settings):
 
     if not settings.STORMPATH_APPLICATION:
         raise ImproperlyConfigured('STORMPATH_APPLICATION must be specified in settings.py.')
+
+
+def bulk_update(model, values, using=None):
+    """Update many rows of ``model``, each with its own values, in one query.
+
+    :param model: The model class.
+    :param dict values: Maps primary keys to dicts of ``{field name: value}``.
+        Fields missing for a row are left untouched.
+    :param str using: The database alias to use.
+
+    Model ``save()`` methods (and signals) are bypassed, so nothing is pushed
+    to Stormpath.
+    """
+    from django.db.models import Case, F, Value, When
+
+    if not values:
+        return 0
+
+    names = set()
+    for row in values.values():
+        names.update(row)
+
+    updates = {}
+    for name in names:
+        field = model._meta.get_field(name)
+        whens = [When(pk=pk, then=Value(row[name], output_field=field))
+            for pk, row in values.items() if name in row]
+        updates[field.attname] = Case(*whens, default=F(field.attname), output_field=field)
+
+    return model._base_manager.db_manager(using).filter(pk__in=list(values)).update(**updates)
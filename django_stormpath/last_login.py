@@ -0,0 +1,87 @@
+"""Debounced ``last_login`` updates for Stormpath users.
+
+Django saves the user on every login to update ``last_login``, which for
+Stormpath users means a full remote update on top of the database write.  When
+``STORMPATH_LAST_LOGIN_FLUSH_INTERVAL`` is set, login timestamps are buffered
+in memory instead and written every few seconds with a single query,
+bypassing ``save()``.
+"""
+
+import atexit
+from logging import getLogger
+from threading import Lock, Timer
+
+from django.conf import settings
+from django.contrib.auth.models import update_last_login as django_update_last_login
+from django.contrib.auth.signals import user_logged_in
+from django.db import connections
+from django.utils import timezone
+
+from .helpers import bulk_update
+
+
+log = getLogger(__name__)
+
+
+class LastLoginBuffer(object):
+    """Collects login timestamps and writes them in bulk."""
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = Lock()
+        self._timer = None
+
+    def record(self, user, timestamp):
+        key = (type(user), user._state.db)
+        with self._lock:
+            self._pending.setdefault(key, {})[user.pk] = {'last_login': timestamp}
+            if self._timer is None:
+                interval = getattr(settings, 'STORMPATH_LAST_LOGIN_FLUSH_INTERVAL', None) or 5
+                self._timer = Timer(interval, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        finally:
+            # Every flush runs in a new timer thread, which is done now: close
+            # its connections rather than leaving them open until they time
+            # out (as with CONN_MAX_AGE).
+            connections.close_all()
+
+    def flush(self):
+        """Write all buffered timestamps now."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        for (model, using), values in pending.items():
+            try:
+                bulk_update(model, values, using=using)
+            except Exception:
+                log.exception('Could not update last_login of %d users.', len(values))
+
+
+buffer = LastLoginBuffer()
+atexit.register(buffer.flush)
+
+
+def update_last_login(sender, user, **kwargs):
+    """Replacement for Django's ``update_last_login`` signal receiver."""
+    from .models import StormpathBaseUser
+
+    if not isinstance(user, StormpathBaseUser):
+        return django_update_last_login(sender, user, **kwargs)
+
+    user.last_login = timezone.now()
+    buffer.record(user, user.last_login)
+
+
+def install():
+    """Swap Django's ``last_login`` receiver for the debounced one."""
+    user_logged_in.disconnect(django_update_last_login)
+    user_logged_in.disconnect(dispatch_uid='update_last_login')
+    user_logged_in.connect(update_last_login, dispatch_uid='stormpath_update_last_login')
@@ -0,0 +1,22 @@
+import sys
+
+from django.core.management.base import BaseCommand
+from django_stormpath.backends import get_application
+from django_stormpath.sync import backfill_hrefs
+
+
+class Command(BaseCommand):
+    help = 'Sets the Stormpath href of local users which have none, matching accounts by email.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+            help='Accounts matched per database query.')
+
+    def handle(self, **options):
+        try:
+            count = backfill_hrefs(get_application(), batch_size=options['batch_size'])
+        except Exception as e:
+            self.stderr.write('Error! {}'.format(e))
+            sys.exit(-1)
+
+        self.stdout.write('Set the href of {} users.'.format(count))
@@ -0,0 +1,24 @@
+import sys
+
+from django.core.management.base import BaseCommand
+from django_stormpath.mirror import export_mirror, open_mirror
+
+
+class Command(BaseCommand):
+    help = 'Exports the local users and their groups to a JSON Lines file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path',
+            help='File to write to, compressed if it ends with .gz.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+            help='Users read from the database at a time.')
+
+    def handle(self, **options):
+        try:
+            with open_mirror(options['path'], 'w') as stream:
+                count = export_mirror(stream, chunk_size=options['chunk_size'])
+        except Exception as e:
+            self.stderr.write('Error! {}'.format(e))
+            sys.exit(-1)
+
+        self.stdout.write('Exported {} users to {}.'.format(count, options['path']))
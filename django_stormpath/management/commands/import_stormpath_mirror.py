@@ -0,0 +1,24 @@
+import sys
+
+from django.core.management.base import BaseCommand
+from django_stormpath.mirror import import_mirror, open_mirror
+
+
+class Command(BaseCommand):
+    help = 'Imports users and their groups from a file made by export_stormpath_mirror.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path',
+            help='File to read from, compressed if it ends with .gz.')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+            help='Users written to the database per transaction.')
+
+    def handle(self, **options):
+        try:
+            with open_mirror(options['path']) as stream:
+                count = import_mirror(stream, chunk_size=options['chunk_size'])
+        except Exception as e:
+            self.stderr.write('Error! {}'.format(e))
+            sys.exit(-1)
+
+        self.stdout.write('Imported {} users from {}.'.format(count, options['path']))
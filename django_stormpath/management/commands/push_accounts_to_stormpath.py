@@ -0,0 +1,49 @@
+import sys
+
+import datetime
+
+from django.core.management.base import BaseCommand
+from django_stormpath.sync import AccountPush
+
+
+DEFAULT_FAILURES = 'stormpath-push-failures.jsonl'
+
+
+class Command(BaseCommand):
+    help = 'Creates Stormpath accounts for local users that have none.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+            help='Number of accounts created concurrently.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+            help='Users read from the database at a time.')
+        parser.add_argument('--limit', type=int,
+            help='Stop after this many users.')
+        parser.add_argument('--failures', default=DEFAULT_FAILURES,
+            help='File the users that failed are appended to, as JSON lines.')
+
+    def report_progress(self, push):
+        self.stdout.write('Pushed {pushed} users, {failed} failed'.format(**push.stats) +
+            ' ({:.1f}/s)'.format(push.rate))
+
+    def handle(self, **options):
+        try:
+            start_time = datetime.datetime.now()
+            with open(options['failures'], 'a') as failures:
+                stats = AccountPush(
+                    workers=options['workers'],
+                    chunk_size=options['chunk_size'],
+                    limit=options['limit'],
+                    failures=failures,
+                    progress=self.report_progress).run()
+            duration = datetime.datetime.now() - start_time
+        except Exception as e:
+            self.stderr.write('Error! {}'.format(e))
+            sys.exit(-1)
+
+        self.stdout.write('Pushed {} users to Stormpath in {}.'.format(stats['pushed'], duration))
+        if stats['without_password']:
+            self.stdout.write('{} users have no importable password and need to reset it.'.format(
+                stats['without_password']))
+        if stats['failed']:
+            self.stdout.write('{} users failed, see {}.'.format(stats['failed'], options['failures']))
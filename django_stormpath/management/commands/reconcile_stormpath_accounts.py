@@ -0,0 +1,36 @@
+import sys
+
+from django.core.management.base import BaseCommand
+from django_stormpath.backends import get_application
+from django_stormpath.reconcile import Reconciler
+
+
+class Command(BaseCommand):
+    help = 'Reports (and optionally repairs) differences between local users and Stormpath.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true',
+            help='Update local users from Stormpath where they differ.')
+        parser.add_argument('--batch-size', type=int, default=100,
+            help='Accounts compared per digest (at most 100).')
+
+    def report(self, kind, href, email, changed):
+        line = '{}: {} ({})'.format(kind, email, href)
+        if changed:
+            line += ' ' + ', '.join(changed)
+        self.stdout.write(line)
+
+    def handle(self, **options):
+        try:
+            stats = Reconciler(get_application(),
+                batch_size=options['batch_size'],
+                repair=options['repair'],
+                report=self.report).run()
+        except Exception as e:
+            self.stderr.write('Error! {}'.format(e))
+            sys.exit(-1)
+
+        self.stdout.write(
+            'Compared {accounts} accounts in {batches} batches, {mismatched_batches} '
+            'of which differed: {missing_locally} missing locally, {missing_remotely} '
+            'missing remotely, {different} different.'.format(**stats))
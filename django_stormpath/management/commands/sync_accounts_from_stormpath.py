@@ -2,21 +2,98 @@ import sys
 
 import datetime
 
-from django.core.management.base import BaseCommand
-from django_stormpath.models import APPLICATION, StormpathUserManager
+from django.core.management.base import BaseCommand, CommandError
+from django_stormpath.backends import get_application
+from django_stormpath.sharding import PARTITION_BY_RANGE, PARTITION_BY_STORE, sharded_sync
+from django_stormpath.sync import AccountSync, Checkpoint, MAX_BATCH_SIZE
+
+
+DEFAULT_CHECKPOINT = '.stormpath-sync-checkpoint-{}.json'
+
+
+def get_default_checkpoint(application):
+    """Checkpoint file of ``application``, so applications don't share one."""
+    return DEFAULT_CHECKPOINT.format(application.href.rstrip('/').rsplit('/', 1)[-1])
+
+
+def format_seconds(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
 
 
 class Command(BaseCommand):
     help = 'Syncs remote accounts to the local database.'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--resume', action='store_true',
+            help='Continue an interrupted sync from its checkpoint.')
+        parser.add_argument('--dry-run', action='store_true',
+            help='Only report how many users would be created and updated.')
+        parser.add_argument('--limit', type=int,
+            help='Stop after syncing this many accounts.')
+        parser.add_argument('--batch-size', type=int, default=MAX_BATCH_SIZE,
+            help='Accounts fetched and saved per transaction (at most 100).')
+        parser.add_argument('--checkpoint',
+            help='File the progress is saved to after every batch '
+                '(by default one named after the application).')
+        parser.add_argument('--processes', type=int, default=1,
+            help='Sync partitions of the accounts with this many processes.')
+        parser.add_argument('--partition-by', default=PARTITION_BY_STORE,
+            choices=[PARTITION_BY_STORE, PARTITION_BY_RANGE],
+            help='Partition by account store, or in equal offset ranges.')
+
+    def report_progress(self, sync):
+        state = sync.state
+        line = 'Synced {} of {} accounts ({:.1f}/s'.format(
+            state['offset'], state['total'] or '?', sync.rate)
+        if sync.eta is not None:
+            line += ', ETA {}'.format(format_seconds(sync.eta))
+        self.stdout.write(line + ')')
+
+    def report_partition(self, state):
+        self.stdout.write('Synced partition {partition}: {accounts} accounts, '
+            '{created} created, {updated} updated, {unchanged} unchanged, '
+            '{skipped} skipped'.format(**state))
+
+    def sync(self, application, options):
+        if options['processes'] > 1:
+            return sharded_sync(application,
+                processes=options['processes'],
+                partition_by=options['partition_by'],
+                batch_size=options['batch_size'],
+                dry_run=options['dry_run'],
+                checkpoint=options['checkpoint'],
+                resume=options['resume'],
+                progress=self.report_partition)
+
+        sync = AccountSync(application,
+            batch_size=options['batch_size'],
+            limit=options['limit'],
+            dry_run=options['dry_run'],
+            checkpoint=Checkpoint(options['checkpoint']),
+            progress=self.report_progress)
+        return sync.run(resume=options['resume'])
+
     def handle(self, **options):
+        if options['processes'] > 1 and options['limit'] is not None:
+            raise CommandError('--limit can only be used with a single process.')
+
+        application = get_application()
+        if not options['checkpoint']:
+            options['checkpoint'] = get_default_checkpoint(application)
+
         try:
-            user_manager = StormpathUserManager()
             start_time = datetime.datetime.now()
-            user_manager.sync_accounts_from_stormpath()
+            state = self.sync(application, options)
             duration = datetime.datetime.now() - start_time
-            print('Successfully synced accounts from {} directory in {}'.format(APPLICATION.name, duration))
         except Exception as e:
-            print('Error! {}'.format(e))
+            self.stderr.write('Error! {}'.format(e))
+            if not options['dry_run']:
+                self.stderr.write('Run again with --resume to continue from the last saved batch.')
             sys.exit(-1)
 
+        verb = 'Would sync' if options['dry_run'] else 'Successfully synced'
+        self.stdout.write('{} accounts from {} directory in {}: {} created, {} updated, '
+            '{} unchanged, {} skipped'.format(verb, application.name, duration,
+            state['created'], state['updated'], state['unchanged'], state['skipped']))
+        for phase, seconds in sorted(state['timings'].items()):
+            self.stdout.write('  {}: {:.1f}s'.format(phase, seconds))
@@ -0,0 +1,89 @@
+"""Middleware for Stormpath-backed applications."""
+
+try:
+    from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+    MiddlewareMixin = object
+
+from .backends import StormpathAccessTokenBackend
+from .client import activate_identity_map, deactivate_identity_map
+from .tenants import activate, deactivate, get_application, resolve_application
+from .throttling import get_client_ip, set_client_ip
+from .tokens import get_bearer_token
+
+
+ACCESS_TOKEN_AUTH_BACKEND = 'django_stormpath.backends.StormpathAccessTokenBackend'
+
+
+class StormpathIdentityMapMiddleware(MiddlewareMixin):
+    """Fetch every Stormpath resource at most once per request.
+
+    Code paths like form validation followed by ``save()`` or login followed
+    by group checks read the same account, directory and account store several
+    times.  This middleware memoizes Stormpath responses by href for the
+    lifetime of a single request and throws them away afterwards, so there's
+    no risk of serving data that is stale across requests.
+    """
+
+    def process_request(self, request):
+        activate_identity_map()
+
+    def process_response(self, request, response):
+        deactivate_identity_map()
+        return response
+
+
+class StormpathAccessTokenMiddleware(MiddlewareMixin):
+    """Authenticate requests carrying a Stormpath access token.
+
+    Looks for an ``Authorization: Bearer <token>`` header and, if the token is
+    valid, sets ``request.user`` for this request only (nothing is stored in
+    the session).  Must come after Django's ``AuthenticationMiddleware``.
+    """
+
+    def process_request(self, request):
+        token = get_bearer_token(request)
+        if token is None:
+            return
+
+        user = StormpathAccessTokenBackend().authenticate(access_token=token)
+        if user is not None:
+            user.backend = ACCESS_TOKEN_AUTH_BACKEND
+            request.user = user
+
+
+class StormpathLoginThrottleMiddleware(MiddlewareMixin):
+    """Let the login throttle count failed logins per client IP.
+
+    The IP is taken from ``REMOTE_ADDR``, or from the header named by
+    ``STORMPATH_CLIENT_IP_HEADER`` (e.g. ``HTTP_X_FORWARDED_FOR``) when
+    running behind a proxy.
+    """
+
+    def process_request(self, request):
+        set_client_ip(get_client_ip(request))
+
+    def process_response(self, request, response):
+        set_client_ip(None)
+        return response
+
+
+class StormpathTenantMiddleware(MiddlewareMixin):
+    """Serve every request with the Stormpath application of its tenant.
+
+    The application is resolved from the request (see
+    :mod:`django_stormpath.tenants`), used by everything talking to Stormpath
+    during the request, and available as ``request.stormpath_application``.
+    Must come before the other Stormpath middleware and Django's
+    ``AuthenticationMiddleware``.
+    """
+
+    def process_request(self, request):
+        # None (the default application) also clears a tenant left over
+        # from an earlier request served by this thread.
+        activate(resolve_application(request))
+        request.stormpath_application = get_application()
+
+    def process_response(self, request, response):
+        deactivate()
+        return response
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def dedupe_hrefs(apps, schema_editor):
+    """Make hrefs unique so they can be used as the identity of users.
+
+    Empty hrefs become NULL, and when several users share an href only the
+    most recently created one keeps it.  No rows are deleted.
+
+    Only local data is touched; users left without an href can be matched
+    to their accounts afterwards with ``manage.py backfill_stormpath_hrefs``.
+    """
+    StormpathUser = apps.get_model('django_stormpath', 'StormpathUser')
+
+    StormpathUser.objects.filter(href='').update(href=None)
+
+    duplicates = (StormpathUser.objects.exclude(href=None).values('href')
+        .annotate(users=Count('id')).filter(users__gt=1))
+    for row in duplicates.iterator():
+        ids = list(StormpathUser.objects.filter(href=row['href'])
+            .order_by('-id').values_list('id', flat=True))
+        StormpathUser.objects.filter(id__in=ids[1:]).update(href=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_stormpath', '0003_auto_20160426_1425'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_hrefs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_stormpath', '0004_dedupe_hrefs'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='stormpathuser',
+            name='href',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_stormpath', '0005_href_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stormpathuser',
+            name='idempotency_key',
+            field=models.CharField(editable=False, max_length=32, null=True),
+        ),
+    ]
@@ -0,0 +1,215 @@
+"""Export and import of the local mirror of Stormpath accounts.
+
+The mirror (users, including the fields stored as custom data on Stormpath,
+and their group memberships) is written as JSON Lines, one user per line, so
+it can be moved between environments without calling Stormpath at all::
+
+    {"href": "...", "email": "...", "is_staff": false, ..., "groups": ["admins"]}
+
+Both directions work in chunks with constant memory, and files ending in
+``.gz`` are compressed.
+"""
+
+import gzip
+import io
+import json
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.encoding import force_text, is_protected_type
+
+from .helpers import bulk_update
+from .permissions import bump_permission_version
+
+
+# Never exported: local ids mean nothing elsewhere, and mirrored users have
+# no usable local password anyway.
+EXCLUDED_FIELDS = ('id', 'password')
+
+
+def open_mirror(path, mode='r'):
+    """Open a mirror file for reading (``'r'``) or writing (``'w'``)."""
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode + 'b'), encoding='utf-8')
+
+    return io.open(path, mode, encoding='utf-8')
+
+
+def _fields(model):
+    return [f for f in model._meta.concrete_fields
+        if f.name not in EXCLUDED_FIELDS and not f.primary_key]
+
+
+def _dump(field, user):
+    # Like Django's serializers: keep what JSON (or DjangoJSONEncoder) can
+    # represent, such as None and dates, and use strings for the rest.
+    value = field.value_from_object(user)
+    if is_protected_type(value):
+        return value
+
+    return field.value_to_string(user)
+
+
+def _chunked_users(chunk_size):
+    UserModel = get_user_model()
+    users = UserModel._default_manager.order_by('pk').prefetch_related('groups')
+
+    last_pk = None
+    while True:
+        chunk = users if last_pk is None else users.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def export_mirror(stream, chunk_size=1000):
+    """Write every local user to ``stream`` and return how many there were."""
+    fields = _fields(get_user_model())
+
+    count = 0
+    for chunk in _chunked_users(chunk_size):
+        for user in chunk:
+            row = dict((f.name, _dump(f, user)) for f in fields)
+            row['groups'] = sorted(g.name for g in user.groups.all())
+            line = json.dumps(row, sort_keys=True, cls=DjangoJSONEncoder)
+            stream.write(force_text(line) + u'\n')
+        count += len(chunk)
+
+    return count
+
+
+def _chunked_rows(stream, chunk_size):
+    chunk = []
+    for line in stream:
+        if line.strip():
+            chunk.append(json.loads(line))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _dedupe(rows):
+    """Drop rows for a user (by href or email) that appears again later."""
+    seen = set()
+    kept = []
+    for row in reversed(rows):
+        keys = set([('email', row['email'])])
+        if row.get('href'):
+            keys.add(('href', row['href']))
+        if not keys & seen:
+            kept.append(row)
+        seen |= keys
+
+    kept.reverse()
+    return kept
+
+
+def _import_chunk(rows, fields):
+    UserModel = get_user_model()
+    manager = UserModel._default_manager
+    rows = _dedupe(rows)
+
+    # Current values only, model instances are built for new users alone.
+    hrefs = [r['href'] for r in rows if r.get('href')]
+    users = dict((u['href'], u) for u in manager.filter(href__in=hrefs).values())
+    by_email = dict((u['email'], u) for u in manager.filter(
+        email__in=[r['email'] for r in rows if r.get('href') not in users]).values())
+
+    pk = UserModel._meta.pk.attname
+    to_create = []
+    updates = {}
+    for row in rows:
+        values = dict((f.name, f.to_python(row[f.name])) for f in fields if f.name in row)
+        if not values.get('href'):
+            values['href'] = None
+
+        current = users.get(row.get('href')) or by_email.get(row['email'])
+        if current is None:
+            user = UserModel(**values)
+            user.set_unusable_password()
+            to_create.append(user)
+        else:
+            changes = dict((f.name, values[f.name]) for f in fields
+                if f.name in values and values[f.name] != current[f.attname])
+            if changes:
+                updates[current[pk]] = changes
+
+    # Neither writes call save(), so nothing is pushed to Stormpath.
+    manager.bulk_create(to_create)
+    bulk_update(UserModel, updates)
+
+    # bulk_create doesn't set primary keys on every database.
+    pks = dict(manager.filter(email__in=[r['email'] for r in rows]).values_list('email', 'pk'))
+    groups = _current_groups(pks.values())
+    _import_memberships(dict((pks[r['email']], r.get('groups', [])) for r in rows
+        if set(r.get('groups', [])) != groups.get(pks[r['email']], set())))
+
+
+def _current_groups(user_pks):
+    """Map user pks to the names of their groups."""
+    UserModel = get_user_model()
+    Membership = UserModel.groups.through
+    user_field = UserModel.groups.field.m2m_field_name() + '_id'
+    group_name = UserModel.groups.field.m2m_reverse_field_name() + '__name'
+
+    groups = {}
+    for user_pk, name in Membership.objects.filter(**{
+            user_field + '__in': list(user_pks),
+            }).values_list(user_field, group_name):
+        groups.setdefault(user_pk, set()).add(name)
+
+    return groups
+
+
+def _import_memberships(memberships):
+    """Replace the groups of users, given as ``{user pk: [group names]}``."""
+    if not memberships:
+        return
+
+    UserModel = get_user_model()
+    Membership = UserModel.groups.through
+    user_field = UserModel.groups.field.m2m_field_name() + '_id'
+    group_field = UserModel.groups.field.m2m_reverse_field_name() + '_id'
+
+    names = set(n for groups in memberships.values() for n in groups)
+    existing = set(Group.objects.filter(name__in=list(names)).values_list('name', flat=True))
+    # bulk_create doesn't send pre_save, so nothing is pushed to Stormpath.
+    Group.objects.bulk_create([Group(name=n) for n in names - existing])
+    group_ids = dict(Group.objects.filter(name__in=list(names)).values_list('name', 'pk'))
+
+    Membership.objects.filter(**{user_field + '__in': list(memberships)}).delete()
+    Membership.objects.bulk_create([
+        Membership(**{user_field: user_pk, group_field: group_ids[name]})
+        for user_pk, groups in memberships.items()
+        for name in groups
+    ])
+
+    # Bulk operations don't send m2m_changed, so invalidate by hand.
+    bump_permission_version(list(memberships))
+
+
+def import_mirror(stream, chunk_size=1000):
+    """Create or update local users from ``stream``.
+
+    Users are matched by href, then by email, and only the fields and group
+    memberships that differ are written.  If a chunk holds a user more than
+    once, the last row wins.  Every chunk is written in its own
+    transaction with bulk queries.  Returns the number of users read.
+    """
+    fields = _fields(get_user_model())
+
+    count = 0
+    for rows in _chunked_rows(stream, chunk_size):
+        with transaction.atomic():
+            _import_chunk(rows, fields)
+        count += len(rows)
+
+    return count
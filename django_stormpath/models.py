@@ -7,41 +7,66 @@ application that modifies user data on Stormpath. If needing to add more
 fields please extend the StormpathUser class from this module.
 """
 
+from contextlib import contextmanager
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
+
 from django.conf import settings
-from django.db import models, IntegrityError, transaction
+from django.db import models, IntegrityError, router, transaction
 from django.contrib.auth.models import (BaseUserManager,
         AbstractBaseUser, PermissionsMixin)
 from django.forms import model_to_dict
 from django.core.exceptions import ObjectDoesNotExist
-from django.db.models.signals import pre_save, pre_delete
+from django.db.models.signals import pre_save, pre_delete, post_delete, m2m_changed
+from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
 from django.dispatch import receiver
 from django import VERSION as django_version
 
+from requests.exceptions import RequestException
 from stormpath.client import Client
 from stormpath.error import Error as StormpathError
-from stormpath.resources import AccountCreationPolicy
+from stormpath.resources.account import Account
+from stormpath.resources.base import Expansion
 
 from django_stormpath import __version__
+from django_stormpath.client import idempotent, install_executor
+from django_stormpath.directories import get_account_policy, get_directory_policy
 from django_stormpath.helpers import validate_settings
+from django_stormpath.permissions import bump_permission_version
+from django_stormpath.ratelimit import BATCH, get_priority, priority
+from django_stormpath.sync import AccountPush, AccountSync
+from django_stormpath.tenants import get_application, remote_group_name
 
 
 # Ensure all user settings have been properly initialized, otherwise we'll
 # throw useful error messages to the user so they know what to fix.
 validate_settings(settings)
 
+log = getLogger(__name__)
+
 
 # Initialize our Stormpath Client / Application objects -- this way we have
 # singletons that can be used throughout our Django sessions.
 USER_AGENT = 'stormpath-django/%s django/%s' % (__version__, django_version)
 
-CLIENT = Client(
-    id = settings.STORMPATH_ID,
-    secret = settings.STORMPATH_SECRET,
-    user_agent = USER_AGENT,
-    cache_options = getattr(settings, 'STORMPATH_CACHE_OPTIONS', None)
-)
+def create_client():
+    """Create a Stormpath client configured from the settings."""
+    client = Client(
+        id = settings.STORMPATH_ID,
+        secret = settings.STORMPATH_SECRET,
+        user_agent = USER_AGENT,
+        cache_options = getattr(settings, 'STORMPATH_CACHE_OPTIONS', None)
+    )
+    install_executor(client)
+    return client
+
+
+CLIENT = create_client()
 
+# The default application.  Use django_stormpath.tenants.get_application() to
+# get the application of the current tenant.
 APPLICATION = CLIENT.applications.get(settings.STORMPATH_APPLICATION)
 
 
@@ -50,13 +75,102 @@ def get_default_is_active():
     Stormpath user is active by default if e-mail verification is
     disabled.
     """
-    directory = APPLICATION.default_account_store_mapping.account_store
-    verif_email = directory.account_creation_policy.verification_email_status
-    return verif_email == AccountCreationPolicy.EMAIL_STATUS_DISABLED
+    return get_directory_policy().is_active_by_default
+
+
+def prefetch_stormpath_accounts(users, expand=None, workers=8):
+    """Fetch the Stormpath accounts of ``users`` concurrently.
+
+    Every user gets its account in ``stormpath_account`` (None if the account
+    is gone).  Accounts are fetched by ``workers`` threads, with the
+    resources named in ``expand`` (e.g. ``['customData', 'groups']``)
+    included in the same calls.
+    """
+    users = [u for u in users if u.href]
+    hrefs = list(set(u.href for u in users))
+    if not hrefs:
+        return
+
+    expansion = Expansion(*expand) if expand else None
+    # The priority is per thread, so hand ours over to the pool.
+    level = get_priority()
+
+    def fetch(href):
+        with priority(level):
+            try:
+                account = CLIENT.accounts.get(href, expand=expansion)
+                # Materialize it here rather than in the caller's thread.
+                account.email
+                return account
+            except StormpathError as e:
+                if e.status == 404:
+                    return None
+                raise
+
+    pool = ThreadPool(min(workers, len(hrefs)))
+    try:
+        accounts = dict(zip(hrefs, pool.map(fetch, hrefs)))
+    finally:
+        pool.close()
+        pool.join()
+
+    for user in users:
+        user._stormpath_account = accounts[user.href]
+
+
+class StormpathUserQuerySet(models.QuerySet):
+
+    def __init__(self, *args, **kwargs):
+        super(StormpathUserQuerySet, self).__init__(*args, **kwargs)
+        self._stormpath_prefetch = None
+
+    def _clone(self, *args, **kwargs):
+        clone = super(StormpathUserQuerySet, self)._clone(*args, **kwargs)
+        clone._stormpath_prefetch = self._stormpath_prefetch
+        return clone
+
+    def prefetch_stormpath(self, expand=None, workers=8):
+        """Fetch the Stormpath accounts of the users when evaluated.
+
+        Like ``prefetch_related``: the accounts are fetched concurrently
+        once the users are loaded, see :func:`prefetch_stormpath_accounts`.
+        """
+        clone = self._clone()
+        clone._stormpath_prefetch = (expand, workers)
+        return clone
+
+    def _fetch_all(self):
+        prefetch = self._result_cache is None and self._stormpath_prefetch
+        super(StormpathUserQuerySet, self)._fetch_all()
+        if prefetch:
+            # values() and values_list() rows have no account to attach.
+            prefetch_stormpath_accounts(
+                [u for u in self._result_cache if isinstance(u, self.model)],
+                *self._stormpath_prefetch)
+
+
+def can_coalesce_writes():
+    """Whether Stormpath writes made in a transaction can be deferred."""
+    if not getattr(settings, 'STORMPATH_COALESCE_WRITES', False):
+        return False
+
+    # transaction.on_commit is only available on Django 1.9+.
+    return hasattr(transaction, 'on_commit')
+
+
+@contextmanager
+def _no_transaction():
+    yield
 
 
 class StormpathUserManager(BaseUserManager):
 
+    def get_queryset(self):
+        return StormpathUserQuerySet(self.model, using=self._db)
+
+    def prefetch_stormpath(self, expand=None, workers=8):
+        return self.get_queryset().prefetch_stormpath(expand, workers)
+
     def get(self, *args, **kwargs):
         try:
             password = kwargs.pop('password')
@@ -67,7 +181,7 @@ class StormpathUserManager(BaseUserManager):
 
         if password:
             try:
-                APPLICATION.authenticate_account(
+                get_application().authenticate_account(
                     getattr(user, user.USERNAME_FIELD), password)
             except StormpathError:
                 raise self.model.DoesNotExist
@@ -83,7 +197,7 @@ class StormpathUserManager(BaseUserManager):
         except self.model.DoesNotExist:
             return self.create(**kwargs), True
 
-    def update_or_create(self, defaults=None, **kwargs):
+    def _update_or_create(self, defaults=None, **kwargs):
         defaults = defaults or {}
         try:
             user = self.get(**kwargs)
@@ -99,6 +213,23 @@ class StormpathUserManager(BaseUserManager):
         user._remove_raw_password()
         return user, False
 
+    def _coalescing(self):
+        """A transaction to coalesce several saves of a user in.
+
+        Only opened if the saves would actually be deferred: otherwise the
+        remote writes would run inside our transaction, and a rollback would
+        leave them behind on Stormpath.
+        """
+        if can_coalesce_writes():
+            return transaction.atomic(using=self._db)
+        return _no_transaction()
+
+    def update_or_create(self, defaults=None, **kwargs):
+        # Both saves of a new user become a single Stormpath write if
+        # STORMPATH_COALESCE_WRITES is on.
+        with self._coalescing():
+            return self._update_or_create(defaults, **kwargs)
+
     def _create_user(self, email, given_name, surname, password):
         if not email:
             raise ValueError("Users must have an email address")
@@ -125,60 +256,45 @@ class StormpathUserManager(BaseUserManager):
                           password=password)
 
     def create_superuser(self, **kwargs):
-        user = self.create_user(**kwargs)
-        user.is_admin = True
-        user.is_staff = True
-        user.is_superuser = True
-        user.save(using=self._db)
+        with self._coalescing():
+            user = self.create_user(**kwargs)
+            user.is_admin = True
+            user.is_staff = True
+            user.is_superuser = True
+            user.save(using=self._db)
         user._remove_raw_password()
         return user
 
     def delete(self, *args, **kwargs):
-        for user in self.get_queryset():
-            user.delete(*args, **kwargs)
+        with priority(BATCH):
+            for user in self.get_queryset():
+                user.delete(*args, **kwargs)
 
         # Clear the result cache, in case this QuerySet gets reused.
         self._result_cache = None
 
-    def sync_accounts_from_stormpath(self, sync_groups=True):
+    def sync_accounts_from_stormpath(self, sync_groups=True, **kwargs):
         """ :arg sync_groups: WARNING!!! Groups will be deleted from stormpath
                                 if not present locally when user logs in!
 
         Sync accounts from stormpath -> local database.
         This may take a long time, depending on how many users you have in your
-        Stormpath application. It also makes numerous database queries.
+        Stormpath application. Accounts are fetched and saved in batches, see
+        :class:`django_stormpath.sync.AccountSync` for the other arguments.
 
         This method updates local users from stormpath or creates new ones
         where the user does not exist locally. This is an additive operation,
         meaning it should delete no data from the local database OR stormpath.
         """
-        if sync_groups:
-            sp_groups = [g.name for g in APPLICATION.groups]
-            db_groups = set(Group.objects.all().values_list('name', flat=True))
-            missing_from_db = set(sp_groups).difference(db_groups)
-            if missing_from_db:
-                groups_to_create = []
-                for g_name in missing_from_db:
-                    groups_to_create.append(Group(name=g_name))
-                Group.objects.bulk_create(groups_to_create)
-
-        for account in APPLICATION.accounts:
-            try:
-                user = StormpathUser.objects.get(email=account.email)
-                created = True
-            except StormpathUser.DoesNotExist:
-                user = StormpathUser()
-                created = True
-            user._mirror_data_from_stormpath_account(account)
-            user.set_unusable_password()
-
-            if created:
-                user._save_db_only()
-
-            if sync_groups:
-                users_sp_groups = [g.name for g in account.groups]
-                user.groups = Group.objects.filter(name__in=users_sp_groups)
-            user._save_db_only()
+        return AccountSync(get_application(), sync_groups=sync_groups, **kwargs).run()
+
+    def push_accounts_to_stormpath(self, **kwargs):
+        """Create Stormpath accounts for local users that don't have one.
+
+        Meant for migrating an existing user table to Stormpath, see
+        :class:`django_stormpath.sync.AccountPush` for the arguments.
+        """
+        return AccountPush(**kwargs).run()
 
     delete.alters_data = True
     delete.queryset_only = True
@@ -189,7 +305,7 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
     class Meta:
         abstract = True
 
-    href = models.CharField(max_length=255, null=True, blank=True)
+    href = models.CharField(max_length=255, null=True, blank=True, unique=True)
     username = models.CharField(max_length=255, unique=True)
     given_name = models.CharField(max_length=255)
     surname = models.CharField(max_length=255)
@@ -198,10 +314,19 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
         max_length=255,
         unique=True,
         db_index=True)
+    # Sent along when creating the account, so a retried create can tell
+    # whether an earlier attempt already went through.
+    idempotency_key = models.CharField(max_length=32, null=True, editable=False)
 
     STORMPATH_BASE_FIELDS = ['href', 'username', 'given_name', 'surname', 'middle_name', 'email', 'password']
     EXCLUDE_FIELDS = ['href', 'last_login', 'groups', 'id', 'stormpathpermissionsmixin_ptr', 'user_permissions']
 
+    # The other fields are stored as custom data on Stormpath.  Subclasses
+    # can list the ones to sync in STORMPATH_SYNC_FIELDS (None syncs them
+    # all), and keep fields out of Stormpath with LOCAL_ONLY_FIELDS.
+    STORMPATH_SYNC_FIELDS = None
+    LOCAL_ONLY_FIELDS = []
+
     PASSWORD_FIELD = 'password'
 
     USERNAME_FIELD = 'email'
@@ -215,6 +340,7 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
     objects = StormpathUserManager()
 
     DJANGO_PREFIX = 'spDjango_'
+    IDEMPOTENCY_KEY = DJANGO_PREFIX + 'idempotency_key'
 
     @property
     def first_name(self):
@@ -238,29 +364,98 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
     def last_name(self, value):
         self.surname = value
 
-    def _mirror_data_from_db_user(self, account, data):
+    def _account_properties(self, data):
+        """Turn local user ``data`` into Stormpath account properties."""
         for field in self.EXCLUDE_FIELDS:
             if field in data:
                 del data[field]
 
         if data['is_active']:
-            account.status = account.STATUS_ENABLED
+            status = Account.STATUS_ENABLED
         elif data['is_verified']:
-            account.status = account.STATUS_DISABLED
+            status = Account.STATUS_DISABLED
         else:
-            account.status = account.STATUS_UNVERIFIED
+            status = Account.STATUS_UNVERIFIED
 
         if 'is_active' in data:
             del data['is_active']
 
+        custom_fields = self._custom_data_fields()
+        properties = {'status': status, 'custom_data': {}}
         for key in data:
             if key in self.STORMPATH_BASE_FIELDS:
-                account[key] = data[key]
-            else:
-                account.custom_data[self.DJANGO_PREFIX + key] = data[key]
+                properties[key] = data[key]
+            elif key in custom_fields:
+                properties['custom_data'][self.DJANGO_PREFIX + key] = data[key]
+
+        return properties
+
+    def _mirror_data_from_db_user(self, account, data):
+        properties = self._account_properties(data)
+
+        account.status = properties.pop('status')
+        custom_data = properties.pop('custom_data')
+        if custom_data:
+            # Only send the values that changed.
+            current = self._synced_custom_data(account)
+            for key, value in custom_data.items():
+                if key not in current or current[key] != value:
+                    account.custom_data[key] = value
+        for key, value in properties.items():
+            account[key] = value
 
         return account
 
+    def _snapshot_stormpath_account(self, account):
+        """Return what :meth:`_mirror_data_from_db_user` may overwrite."""
+        snapshot = dict((f, account[f]) for f in self.STORMPATH_BASE_FIELDS
+            if f not in ('href', 'password'))
+        snapshot['status'] = account.status
+        snapshot['custom_data'] = self._synced_custom_data(account)
+        return snapshot
+
+    def _restore_stormpath_account(self, account, snapshot):
+        """Put back the account state saved by :meth:`_snapshot_stormpath_account`."""
+        snapshot = dict(snapshot)
+        custom_data = snapshot.pop('custom_data')
+        try:
+            for key in self._synced_custom_data(account):
+                if key not in custom_data:
+                    del account.custom_data[key]
+            for key, value in custom_data.items():
+                account.custom_data[key] = value
+            account.status = snapshot.pop('status')
+            for key, value in snapshot.items():
+                account[key] = value
+            account.save()
+        except StormpathError:
+            log.exception('Could not restore Stormpath account %s.', account.href)
+
+    @classmethod
+    def _custom_data_fields(cls):
+        """Names of the fields stored as custom data on Stormpath."""
+        fields = set(f.name for f in cls._meta.concrete_fields
+            if f.name not in cls.STORMPATH_BASE_FIELDS and
+            f.name not in cls.EXCLUDE_FIELDS and f.name != 'is_active' and
+            f.name not in cls.LOCAL_ONLY_FIELDS and not f.primary_key)
+        if cls.STORMPATH_SYNC_FIELDS is not None:
+            fields &= set(cls.STORMPATH_SYNC_FIELDS)
+        return fields
+
+    @classmethod
+    def _synced_custom_data(cls, account):
+        """The custom data of ``account`` that holds synced fields.
+
+        Custom data is only fetched if there are fields to sync at all.
+        """
+        fields = cls._custom_data_fields()
+        if not fields:
+            return {}
+
+        keys = set(cls.DJANGO_PREFIX + f for f in fields)
+        custom_data = account.custom_data
+        return dict((k, custom_data[k]) for k in custom_data.keys() if k in keys)
+
     def _mirror_data_from_stormpath_account(self, account):
         for field in self.STORMPATH_BASE_FIELDS:
             # The password is not sent via the API
@@ -268,20 +463,25 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
             # mirror it because it's not there
             if field != 'password':
                 self.__setattr__(field, account[field])
-        for key in account.custom_data.keys():
-            self.__setattr__(key.split(self.DJANGO_PREFIX)[0], account.custom_data[key])
+        for key, value in self._synced_custom_data(account).items():
+            self.__setattr__(key[len(self.DJANGO_PREFIX):], value)
 
         if account.status == account.STATUS_ENABLED:
             self.is_active = True
-            self.is_verified = not get_default_is_active()
+            # Verification is up to the directory the account lives in.
+            self.is_verified = not get_account_policy(account).is_active_by_default
         else:
             self.is_active = False
             if account.status == account.STATUS_UNVERIFIED:
                 self.is_verified = False
 
-    def _save_sp_group_memberships(self, account):
+    def _save_sp_group_memberships(self, account, group_names=None):
         try:
-            db_groups = self.groups.values_list('name', flat=True)
+            if group_names is None:
+                group_names = self.groups.values_list('name', flat=True)
+            # Only the groups of the current tenant, by their remote names.
+            db_groups = [n for n in (remote_group_name(g) for g in group_names)
+                if n is not None]
             for g in db_groups:
                 if not account.has_group(g):
                     account.add_group(g)
@@ -294,12 +494,61 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
         except Exception:
             raise IntegrityError("Unable to save group memberships.")
 
-    def _create_stormpath_user(self, data, raw_password):
-        data['password'] = raw_password
-        account = APPLICATION.accounts.create(data)
-        self._save_sp_group_memberships(account)
+    def _create_stormpath_user(self, data, raw_password, password_format=None,
+            group_names=None):
+        properties = self._account_properties(data)
+        properties['password'] = raw_password
+        properties['custom_data'][self.IDEMPOTENCY_KEY] = self.idempotency_key
+
+        # Let the directory pick the initial status and only correct it if
+        # ours differs, as not every status may be set on creation.
+        status = properties.pop('status')
+        recovered = False
+        try:
+            # Safe to retry: a repeated create is matched by its key below.
+            with idempotent():
+                if password_format:
+                    account = get_application().accounts.create(properties,
+                        password_format=password_format)
+                else:
+                    account = get_application().accounts.create(properties)
+        except (StormpathError, RequestException) as e:
+            # A conflict, server error or timeout may mean an earlier attempt
+            # (or this one) created the account after all.
+            error_status = getattr(e, 'status', None)
+            if error_status is not None and error_status != 409 and error_status < 500:
+                raise
+            account = self._find_created_account()
+            if account is None:
+                raise
+            recovered = True
+        if account.status != status:
+            account.status = status
+            account.save()
+
+        # A user that isn't saved locally yet has no groups.
+        if group_names is None and self.pk:
+            group_names = list(self.groups.values_list('name', flat=True))
+            # A new account has no memberships to remove.
+            if group_names or recovered:
+                self._save_sp_group_memberships(account, group_names)
+        elif group_names:
+            self._save_sp_group_memberships(account, group_names)
         return account
 
+    def _find_created_account(self):
+        """Return the account created with our idempotency key, if any."""
+        if not self.idempotency_key:
+            return None
+
+        for account in get_application().accounts.search({'email': self.email}):
+            custom_data = account.custom_data
+            if (self.IDEMPOTENCY_KEY in custom_data.keys() and
+                    custom_data[self.IDEMPOTENCY_KEY] == self.idempotency_key):
+                return account
+
+        return None
+
     def _update_stormpath_user(self, data, raw_password):
         # if password has changed
         if raw_password:
@@ -308,14 +557,16 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
             # don't set the password if it hasn't changed
             del data['password']
         try:
-            acc = APPLICATION.accounts.get(data.get('href'))
+            acc = get_application().accounts.get(data.get('href'))
             # materialize it
             acc.email
+            snapshot = self._snapshot_stormpath_account(acc)
 
             acc = self._mirror_data_from_db_user(acc, data)
-            acc.save()
+            with idempotent():
+                acc.save()
             self._save_sp_group_memberships(acc)
-            return acc
+            return acc, snapshot
         except StormpathError as e:
             if e.status == 404:
                 raise self.DoesNotExist('Could not find Stormpath User.')
@@ -324,6 +575,18 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
         finally:
             self._remove_raw_password()
 
+    @property
+    def stormpath_account(self):
+        """The Stormpath account of this user, fetched on first access.
+
+        Use ``prefetch_stormpath()`` to fetch the accounts of many users at
+        once.
+        """
+        if not hasattr(self, '_stormpath_account'):
+            self._stormpath_account = (get_application().accounts.get(self.href)
+                if self.href else None)
+        return self._stormpath_account
+
     def get_full_name(self):
         return "%s %s" % (self.given_name, self.surname)
 
@@ -333,38 +596,59 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
     def __unicode__(self):
         return self.get_full_name()
 
+    # Remote calls are never made inside a transaction we open: Stormpath
+    # is written first, then the local row in a short transaction, and the
+    # remote write is compensated for if the local one fails.  That way row
+    # locks are only held for local work.  The manager only wraps several
+    # saves in a transaction when the writes are coalesced, i.e. deferred
+    # until after it commits.
+
     def _update_for_db_and_stormpath(self, *args, **kwargs):
+        using = kwargs.get('using')
         try:
-            with transaction.atomic():
-                super(StormpathBaseUser, self).save(*args, **kwargs)
-                self._update_stormpath_user(model_to_dict(self), self._get_raw_password())
-        except StormpathError:
-            raise
+            account, snapshot = self._update_stormpath_user(
+                model_to_dict(self), self._get_raw_password())
         except ObjectDoesNotExist:
-            self.delete()
+            # The account is gone, so only the local user is left to delete.
+            super(StormpathBaseUser, self).delete(using=using)
             raise
+
+        try:
+            with transaction.atomic(using=using):
+                super(StormpathBaseUser, self).save(*args, **kwargs)
         except Exception:
+            self._restore_stormpath_account(account, snapshot)
             raise
 
     def _create_for_db_and_stormpath(self, *args, **kwargs):
         try:
-            with transaction.atomic():
-                super(StormpathBaseUser, self).save(*args, **kwargs)
-                account = self._create_stormpath_user(model_to_dict(self), self._get_raw_password())
-                self.href = account.href
-                self.username = account.username
-                self.save(*args, **kwargs)
-        except StormpathError:
+            account = self._create_stormpath_user(model_to_dict(self), self._get_raw_password())
+        except StormpathError as e:
+            # The email is taken, which is what the local unique index
+            # would have told us had we saved first.
+            if e.status == 409:
+                raise IntegrityError(e)
             raise
+        self.href = account.href
+        self.username = account.username
+
+        try:
+            with transaction.atomic(using=kwargs.get('using')):
+                super(StormpathBaseUser, self).save(*args, **kwargs)
         except Exception:
-            # we're not sure if we have a href yet, hence we
-            # filter by email
-            accounts = APPLICATION.accounts.search({'email': self.email})
-            if accounts:
-                accounts[0].delete()
+            # The account was created for this user only, so it's safe to
+            # delete it by href.
+            self.href = None
+            try:
+                account.delete()
+            except StormpathError:
+                log.exception('Could not delete Stormpath account %s.', account.href)
             raise
 
     def _save_db_only(self, *args, **kwargs):
+        # An empty href would clash with other users' under the unique index.
+        if not self.href:
+            self.href = None
         super(StormpathBaseUser, self).save(*args, **kwargs)
 
     def _remove_raw_password(self):
@@ -389,7 +673,7 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
 
     def check_password(self, raw_password):
         try:
-            acc = APPLICATION.authenticate_account(self.username, raw_password)
+            acc = get_application().authenticate_account(self.username, raw_password)
             return acc is not None
         except StormpathError as e:
             # explicity check to see if password is incorrect
@@ -397,24 +681,89 @@ class StormpathBaseUser(AbstractBaseUser, PermissionsMixin):
                 return False
             raise e
 
+    def _coalesce_writes(self, using=None):
+        """Should Stormpath writes be deferred until the transaction commits?"""
+        if not can_coalesce_writes():
+            return False
+
+        using = using or router.db_for_write(type(self), instance=self)
+        return transaction.get_connection(using).in_atomic_block
+
+    def _save_and_defer_stormpath_write(self, *args, **kwargs):
+        """Save locally and push to Stormpath once the transaction commits.
+
+        Every save schedules a flush, but only the one scheduled by the last
+        save actually writes, with the state the user has at commit time.  So
+        N saves in a transaction cost a single Stormpath write.
+        """
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+
+        # Callers remove the raw password right after saving, so keep it
+        # until the flush.
+        raw_password = self._get_raw_password()
+        if raw_password is not None:
+            self._pending_raw_password = raw_password
+
+        self._save_db_only(*args, **kwargs)
+
+        self._pending_write = getattr(self, '_pending_write', 0) + 1
+        pending_write = self._pending_write
+        transaction.on_commit(
+            lambda: self._flush_stormpath_write(pending_write, using), using=using)
+
+    def _flush_stormpath_write(self, pending_write, using):
+        if pending_write != self._pending_write:
+            return  # a later save will push the changes
+
+        raw_password = self.__dict__.pop('_pending_raw_password', None)
+
+        if self.href:
+            try:
+                self._update_stormpath_user(model_to_dict(self), raw_password)
+            except ObjectDoesNotExist:
+                super(StormpathBaseUser, self).delete(using=using)
+                raise
+            return
+
+        try:
+            account = self._create_stormpath_user(model_to_dict(self), raw_password)
+        except Exception:
+            # Don't leave a user behind that doesn't exist on Stormpath.
+            super(StormpathBaseUser, self).delete(using=using)
+            raise
+
+        self.href = account.href
+        self.username = account.username
+        super(StormpathBaseUser, self).save(using=using,
+            update_fields=['href', 'username', 'idempotency_key'])
+
     def save(self, *args, **kwargs):
         self.username = getattr(self, self.USERNAME_FIELD)
+        if not self.href:
+            self.href = None
+            if not self.idempotency_key:
+                self.idempotency_key = uuid4().hex
+        if self._coalesce_writes(kwargs.get('using')):
+            self._save_and_defer_stormpath_write(*args, **kwargs)
         # Are we updating an existing User?
-        if self.id:
+        elif self.id:
             self._update_for_db_and_stormpath(*args, **kwargs)
         # Or are we creating a new user?
         else:
             self._create_for_db_and_stormpath(*args, **kwargs)
 
     def delete(self, *args, **kwargs):
-        with transaction.atomic():
-            href = self.href
-            super(StormpathBaseUser, self).delete(*args, **kwargs)
+        # Delete the account first: if the local delete fails it can simply
+        # be retried, as an account that is already gone is ignored.
+        if self.href:
             try:
-                account = APPLICATION.accounts.get(href)
-                account.delete()
-            except StormpathError:
-                raise
+                get_application().accounts.get(self.href).delete()
+            except StormpathError as e:
+                if e.status != 404:
+                    raise
+
+        with transaction.atomic(using=kwargs.get('using')):
+            super(StormpathBaseUser, self).delete(*args, **kwargs)
 
 
 class StormpathUser(StormpathBaseUser):
@@ -423,25 +772,31 @@ class StormpathUser(StormpathBaseUser):
 
 @receiver(pre_save, sender=Group)
 def save_group_to_stormpath(sender, instance, **kwargs):
+    application = get_application()
+    name = remote_group_name(instance.name)
+    if name is None:
+        return  # a group of another tenant
+
     try:
         if instance.pk is None:
             # creating a new group
-            APPLICATION.groups.create({'name': instance.name})
+            application.groups.create({'name': name})
         else:
             # updating an existing group
             old_group = Group.objects.get(pk=instance.pk)
-            remote_groups = APPLICATION.groups.search({'name': old_group.name})
+            old_name = remote_group_name(old_group.name)
+            remote_groups = application.groups.search({'name': old_name}) if old_name else []
             if len(remote_groups) is 0:
                 # group existed locally but not on Stormpath, create it
-                APPLICATION.groups.create({'name': instance.name})
+                application.groups.create({'name': name})
                 return
 
             remote_group = remote_groups[0]
 
-            if remote_group.name == instance.name:
+            if remote_group.name == name:
                 return  # nothing changed
 
-            remote_group.name = instance.name
+            remote_group.name = name
             remote_group.save()
 
     except StormpathError as e:
@@ -450,7 +805,42 @@ def save_group_to_stormpath(sender, instance, **kwargs):
 
 @receiver(pre_delete, sender=Group)
 def delete_group_from_stormpath(sender, instance, **kwargs):
+    name = remote_group_name(instance.name)
+    if name is None:
+        return  # a group of another tenant
+
     try:
-        APPLICATION.groups.search({'name': instance.name})[0].delete()
+        get_application().groups.search({'name': name})[0].delete()
     except StormpathError as e:
         raise IntegrityError(e)
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_permissions_on_group_delete(sender, instance, **kwargs):
+    bump_permission_version()
+
+
+@receiver(m2m_changed)
+def invalidate_permissions_on_membership_change(sender, instance, action, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    # Nothing was actually added or removed.
+    if pk_set is not None and not pk_set:
+        return
+
+    if sender is Group.permissions.through:
+        bump_permission_version()
+        return
+
+    UserModel = get_user_model()
+    if not issubclass(UserModel, StormpathBaseUser):
+        return
+
+    if sender in (UserModel.groups.through, UserModel.user_permissions.through):
+        if isinstance(instance, UserModel):
+            bump_permission_version([instance.pk])
+        elif pk_set:
+            bump_permission_version(pk_set)
+        else:
+            bump_permission_version()
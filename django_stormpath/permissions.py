@@ -0,0 +1,64 @@
+"""Shared cache of permission sets for Stormpath users.
+
+Django only caches a user's permissions on the user instance, so every request
+computes them again with joins over groups and permissions.  We cache the
+permission set in Django's cache instead, keyed by the user's pk and
+superuser status plus two version numbers: one per user, bumped when that
+user's groups or permissions change, and a global one, bumped when a group's
+permissions change.  Bumping a version makes the old cache entries
+unreachable.  Superusers have every permission, so promoting or demoting a
+user (however it's saved) switches keys without bumping anything.
+"""
+
+from time import time
+
+from django.core.cache import cache
+
+
+PERMISSIONS_CACHE_TIMEOUT = 60 * 60
+
+GLOBAL_VERSION_KEY = 'stormpath:perm-version'
+
+
+def _user_version_key(pk):
+    return 'stormpath:perm-version:%s' % pk
+
+
+def _new_version():
+    # Versions start at the current time rather than at 1, so a version that
+    # was evicted from the cache never comes back with an old value.
+    return int(time() * 1000)
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_version(), None)
+
+
+def bump_permission_version(user_pks=None):
+    """Invalidate cached permission sets.
+
+    :param user_pks: Primary keys of the users whose memberships changed.  If
+        None, the permission sets of all users are invalidated.
+    """
+    if user_pks is None:
+        _bump(GLOBAL_VERSION_KEY)
+    else:
+        for pk in user_pks:
+            _bump(_user_version_key(pk))
+
+
+def get_permissions_cache_key(pk, is_superuser=False):
+    """Return the cache key of the current permission set of user ``pk``."""
+    user_key = _user_version_key(pk)
+    versions = cache.get_many([user_key, GLOBAL_VERSION_KEY])
+
+    for key in (user_key, GLOBAL_VERSION_KEY):
+        if key not in versions:
+            cache.add(key, _new_version(), None)
+            versions[key] = cache.get(key)
+
+    return 'stormpath:perms:%s:%s:%s:%d' % (pk, versions[user_key], versions[GLOBAL_VERSION_KEY],
+        is_superuser)
@@ -0,0 +1,119 @@
+"""Client-side rate limiting of Stormpath API calls.
+
+The API quota of a Stormpath tenant is shared by every process talking to it:
+web workers, cron jobs, management commands.  To coordinate them, calls take a
+token from a bucket kept in Django's cache, refilled with ``rate`` tokens every
+second.  The bucket is a per-second counter bumped with atomic increments, so
+the limit holds across processes as long as they share the cache (memcached,
+redis; the local memory cache only limits a single process).
+
+Calls are made with a priority.  Interactive calls (the default) may use the
+whole bucket, while batch calls leave a ``reserved`` share of it alone, so
+long-running jobs slow themselves down instead of starving logins.  Enable with
+``STORMPATH_RATE_LIMIT``::
+
+    STORMPATH_RATE_LIMIT = {
+        'rate': 20,         # calls per second
+        'reserved': 0.25,   # share of the rate batch calls may not use
+        'max_wait': 1,      # seconds an interactive call waits at most
+    }
+"""
+
+from contextlib import contextmanager
+from logging import getLogger
+from random import uniform
+from threading import local
+from time import sleep, time
+
+from django.conf import settings
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+
+
+log = getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+
+_local = local()
+
+
+@contextmanager
+def priority(name):
+    """Make the Stormpath calls in the block with priority ``name``."""
+    previous = get_priority()
+    _local.priority = name
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def get_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, reserved=0.25, max_wait=1, cache=DEFAULT_CACHE_ALIAS,
+            key_prefix='stormpath:rate'):
+        self.rate = rate
+        self.batch_rate = max(1, int(rate * (1 - reserved)))
+        self.max_wait = max_wait
+        self.cache = caches[cache]
+        self.key_prefix = key_prefix
+
+    def _take(self, limit):
+        key = '%s:%d' % (self.key_prefix, int(time()))
+        # Two seconds are enough for a one second window, and the counter
+        # has to exist before it can be incremented.
+        self.cache.add(key, 0, 2)
+        try:
+            used = self.cache.incr(key)
+        except ValueError:
+            # Evicted right after we added it.
+            self.cache.add(key, 1, 2)
+            return True
+
+        if used <= limit:
+            return True
+
+        # Give the token back so higher priority calls can still have it.
+        self.cache.decr(key)
+        return False
+
+    def acquire(self, priority=INTERACTIVE):
+        """Wait for a token.
+
+        Batch calls wait as long as it takes.  Interactive calls wait up to
+        ``max_wait`` seconds and then go ahead anyway, leaving it to the API
+        (and the retry policy) to throttle them; returns False in that case.
+        """
+        limit = self.batch_rate if priority == BATCH else self.rate
+        deadline = None if priority == BATCH else time() + self.max_wait
+
+        while not self._take(limit):
+            # Wait for the next window, with a little jitter so waiting
+            # processes don't all come back at the same instant.
+            delay = 1 - time() % 1 + uniform(0, 0.05)
+            if deadline is not None and time() + delay > deadline:
+                log.debug('Stormpath rate limit exceeded, calling anyway.')
+                return False
+            sleep(delay)
+
+        return True
+
+
+def get_rate_limiter():
+    """Return the limiter configured by ``STORMPATH_RATE_LIMIT``, if any."""
+    options = getattr(settings, 'STORMPATH_RATE_LIMIT', None)
+    if not options:
+        return None
+
+    return RateLimiter(**options)
+
+
+def acquire():
+    """Wait for a token for the next Stormpath call, if limiting is enabled."""
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        limiter.acquire(get_priority())
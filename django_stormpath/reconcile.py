@@ -0,0 +1,219 @@
+"""Detection (and repair) of drift between local users and Stormpath.
+
+Both sides are reduced to the state that round-trips between them: the
+Stormpath base fields, the account status and the ``spDjango_`` custom data,
+except for fields derived while mirroring, such as ``is_verified``.  The
+remote side is what the local user looks like once the account is mirrored
+into it, so accounts are only reported if mirroring (``repair``) would change
+their user.
+Accounts are read a page at a time, ordered by email, and each page is
+compared with the local users in the same email range by a single digest.
+Only pages whose digests differ are compared account by account.
+
+Stormpath can't compute digests for us, so every account is still fetched
+once (with its custom data expanded, a hundred accounts per call), but
+matching pages cost no per-user work, and reading both sides in order keeps
+memory constant.
+"""
+
+import hashlib
+import json
+from copy import copy
+from itertools import islice
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.forms import model_to_dict
+from django.utils.encoding import force_bytes, force_text
+
+from stormpath.error import Error as StormpathError
+
+from .ratelimit import BATCH, priority
+
+
+MISSING_LOCALLY = 'missing_locally'
+MISSING_REMOTELY = 'missing_remotely'
+DIFFERENT = 'different'
+
+# Derived from the account status and its directory's policy when mirroring,
+# so it never round-trips and isn't compared.
+DERIVED_FIELDS = ('is_verified',)
+
+
+def _drop_derived_fields(state, UserModel):
+    for field in DERIVED_FIELDS:
+        state['custom_data'].pop(UserModel.DJANGO_PREFIX + field, None)
+    return state
+
+
+def account_state(account, UserModel=None, user=None):
+    """The state of ``user`` (or of a new user) once ``account`` is mirrored.
+
+    Fields the account has no custom data for keep the user's values (or the
+    model defaults), and the status is derived the same way as for local
+    users.
+    """
+    UserModel = UserModel or get_user_model()
+    mirrored = copy(user) if user is not None else UserModel()
+    mirrored._mirror_data_from_stormpath_account(account)
+    return user_state(mirrored)
+
+
+def user_state(user):
+    """What the account of ``user`` looks like if it's in sync."""
+    editable = [f.name for f in user._meta.concrete_fields if f.editable]
+    state = user._account_properties(model_to_dict(user, fields=editable))
+    del state['password']
+    state['href'] = user.href
+    return _drop_derived_fields(state, type(user))
+
+
+def digest(state):
+    return hashlib.sha1(force_bytes(json.dumps(state, sort_keys=True, default=force_text))).hexdigest()
+
+
+def batch_digest(digests):
+    """Digest of ``{href: digest}``."""
+    return hashlib.sha1(force_bytes(''.join(
+        '%s:%s;' % item for item in sorted(digests.items())))).hexdigest()
+
+
+def _changed_fields(remote, local):
+    changed = [k for k in set(remote) | set(local)
+        if k != 'custom_data' and remote.get(k) != local.get(k)]
+    remote_data, local_data = remote['custom_data'], local['custom_data']
+    changed.extend(k for k in set(remote_data) | set(local_data)
+        if remote_data.get(k) != local_data.get(k))
+    return sorted(changed)
+
+
+class Reconciler(object):
+    """Compare the accounts of ``application`` with the local users.
+
+    :param batch_size: Accounts compared per digest (at most 100).
+    :param repair: Overwrite drifted local users with their account, and
+        create missing ones.  Users whose account is gone are only
+        reported, never deleted.
+    :param report: Called with ``(kind, href, email, changed fields)`` for
+        every drifted account.
+
+    Local users without an href (never pushed to Stormpath) are ignored.
+    """
+
+    def __init__(self, application, batch_size=100, repair=False, report=None):
+        self.application = application
+        self.batch_size = min(batch_size, 100)
+        self.repair = repair
+        self.report = report
+        self.stats = {'accounts': 0, 'batches': 0, 'mismatched_batches': 0,
+            MISSING_LOCALLY: 0, MISSING_REMOTELY: 0, DIFFERENT: 0}
+
+    def _drift(self, kind, href, email, changed=()):
+        self.stats[kind] += 1
+        if self.report is not None:
+            self.report(kind, href, email, list(changed))
+
+    def _fetch(self, offset):
+        params = {
+            'offset': offset,
+            'limit': self.batch_size,
+            'orderBy': 'email',
+        }
+        if get_user_model()._custom_data_fields():
+            params['expand'] = 'customData'
+        page = self.application.accounts.search(params)
+        return list(islice(page, self.batch_size))
+
+    def _local_users(self, lower, upper):
+        users = get_user_model()._default_manager.filter(href__isnull=False)
+        if lower is not None:
+            users = users.filter(email__gt=lower)
+        if upper is not None:
+            users = users.filter(email__lte=upper)
+        return dict((u.href, u) for u in users)
+
+    def _compare(self, accounts, users):
+        UserModel = get_user_model()
+        remote = dict((a.href, account_state(a, UserModel, users.get(a.href)))
+            for a in accounts)
+        local = dict((h, user_state(u)) for h, u in users.items())
+
+        remote_digests = dict((h, digest(s)) for h, s in remote.items())
+        local_digests = dict((h, digest(s)) for h, s in local.items())
+        if batch_digest(remote_digests) == batch_digest(local_digests):
+            return [], []
+
+        self.stats['mismatched_batches'] += 1
+        drifted = []
+        for account in accounts:
+            if account.href not in local:
+                drifted.append((account, None))
+            elif remote_digests[account.href] != local_digests[account.href]:
+                drifted.append((account, users[account.href]))
+
+        # Users whose account isn't in this page; confirmed at the end, as
+        # the two sides may sort emails slightly differently.
+        unmatched = [u for h, u in users.items() if h not in remote]
+        return drifted, unmatched
+
+    def _resolve(self, account, user):
+        UserModel = get_user_model()
+        if user is None:
+            # Maybe just sorted into another page locally.
+            user = UserModel._default_manager.filter(href=account.href).first()
+            if user is not None and digest(user_state(user)) == digest(account_state(account, UserModel, user)):
+                return
+        if user is None:
+            self._drift(MISSING_LOCALLY, account.href, account.email)
+            user = UserModel()
+        else:
+            self._drift(DIFFERENT, account.href, account.email,
+                _changed_fields(account_state(account, UserModel, user), user_state(user)))
+
+        if self.repair:
+            user._mirror_data_from_stormpath_account(account)
+            if user.pk is None:
+                user.set_unusable_password()
+            user._save_db_only()
+
+    def _confirm_missing(self, users):
+        for user in users:
+            try:
+                self.application.accounts.get(user.href).email
+            except StormpathError as e:
+                if e.status == 404:
+                    self._drift(MISSING_REMOTELY, user.href, user.email)
+                    continue
+                raise
+
+    def run(self):
+        """Compare everything and return the counts of drift found."""
+        unmatched = []
+        offset = 0
+        lower = None
+
+        with priority(BATCH):
+            while True:
+                accounts = self._fetch(offset)
+                # The last page also takes the local users sorted after it.
+                last = len(accounts) < self.batch_size
+                upper = None if last else accounts[-1].email
+                users = self._local_users(lower, upper)
+
+                drifted, missing = self._compare(accounts, users)
+                with transaction.atomic():
+                    for account, user in drifted:
+                        self._resolve(account, user)
+
+                unmatched.extend(missing)
+
+                self.stats['batches'] += 1
+                self.stats['accounts'] += len(accounts)
+                if last:
+                    break
+                offset += len(accounts)
+                lower = upper
+
+            self._confirm_missing(unmatched)
+
+        return self.stats
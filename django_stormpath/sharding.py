@@ -0,0 +1,139 @@
+"""Syncing accounts with a pool of processes.
+
+Once fetching is no longer the bottleneck, a single process syncing accounts is
+busy parsing JSON and building models.  :func:`sharded_sync` splits the
+accounts into partitions -- one per account store mapped to the application
+(directories, groups, organizations), or equal offset ranges of the
+application's accounts -- and syncs them with
+:class:`~django_stormpath.sync.AccountSync` in a ``multiprocessing`` pool.
+
+Every worker process gets its own Stormpath client (HTTP connections can't be
+shared with the parent) and its own database connections.  Nothing here
+imports models at module level, so workers can be spawned as well as forked.
+"""
+
+from multiprocessing import Pool
+
+
+PARTITION_BY_STORE = 'store'
+PARTITION_BY_RANGE = 'range'
+
+
+def _init_worker():
+    import django
+
+    django.setup()
+
+    from django.conf import settings
+    from django_stormpath import models
+
+    models.CLIENT = models.create_client()
+    # Only the default; partitions name the application they belong to.
+    models.APPLICATION = models.CLIENT.applications.get(settings.STORMPATH_APPLICATION)
+
+
+def _get_account_store(client, href):
+    for path, collection in (('/directories/', client.directories),
+            ('/groups/', client.groups), ('/organizations/', client.organizations)):
+        if path in href:
+            return collection.get(href)
+
+    raise ValueError('Unknown account store %s.' % href)
+
+
+def _sync_partition(partition):
+    from django_stormpath import models
+    from django_stormpath.sync import AccountSync, Checkpoint
+    from django_stormpath.tenants import tenant
+
+    options = dict(partition['options'])
+    if partition.get('checkpoint'):
+        options['checkpoint'] = Checkpoint(partition['checkpoint'])
+
+    # The application being synced, which needn't be the default one.
+    application = models.CLIENT.applications.get(partition['application'])
+
+    accounts = None
+    if partition.get('store'):
+        accounts = _get_account_store(models.CLIENT, partition['store']).accounts
+
+    sync = AccountSync(application, accounts=accounts,
+        start=partition.get('start', 0), end=partition.get('end'), **options)
+    with tenant(application):
+        state = sync.run(resume=partition['resume'])
+    state['partition'] = partition.get('store') or '%(start)s-%(end)s' % partition
+    state['accounts'] = state['offset'] - partition.get('start', 0)
+    return state
+
+
+def get_partitions(application, partition_by, processes):
+    """Split the accounts of ``application`` into partitions to sync."""
+    if partition_by == PARTITION_BY_STORE:
+        return [{'store': m.account_store.href} for m in application.account_store_mappings]
+
+    total = len(application.accounts)
+    size = max(1, -(-total // processes))
+    return [{'start': start, 'end': min(start + size, total)}
+        for start in range(0, total, size)]
+
+
+def sharded_sync(application, processes=4, partition_by=PARTITION_BY_STORE,
+        sync_groups=True, batch_size=100, dry_run=False, checkpoint=None,
+        resume=False, progress=None):
+    """Sync the accounts of ``application`` with ``processes`` processes.
+
+    Accounts in several of the application's account stores are synced once
+    per store when partitioning by store.  ``checkpoint`` is a path; every
+    partition saves its progress to its own file next to it, and only resumes
+    from it if the file was saved by the same partition.  ``progress`` is
+    called with the state of every partition that finished.
+
+    Returns the summed up counts and timings (per phase, over all processes)
+    of the partitions.
+    """
+    from django.db import connections
+
+    from .sync import AccountSync
+
+    # Create the groups once, before workers race to create them.
+    if sync_groups:
+        AccountSync(application, dry_run=dry_run)._sync_groups()
+
+    options = {
+        'sync_groups': sync_groups,
+        'batch_size': batch_size,
+        'dry_run': dry_run,
+    }
+    partitions = get_partitions(application, partition_by, processes)
+    for i, partition in enumerate(partitions):
+        partition['application'] = application.href
+        partition['options'] = options
+        partition['resume'] = resume
+        if checkpoint:
+            partition['checkpoint'] = '%s.%d' % (checkpoint, i)
+
+    summary = {'partitions': len(partitions), 'accounts': 0, 'created': 0,
+        'updated': 0, 'unchanged': 0, 'skipped': 0, 'timings': {}}
+
+    # Forked workers would share the sockets of open connections, and
+    # closing them there would close them here too.
+    for connection in connections.all():
+        connection.close()
+
+    pool = Pool(processes, initializer=_init_worker)
+    try:
+        for state in pool.imap_unordered(_sync_partition, partitions):
+            summary['created'] += state['created']
+            summary['updated'] += state['updated']
+            summary['unchanged'] += state['unchanged']
+            summary['skipped'] += state['skipped']
+            summary['accounts'] += state['accounts']
+            for phase, seconds in state['timings'].items():
+                summary['timings'][phase] = summary['timings'].get(phase, 0) + seconds
+            if progress is not None:
+                progress(state)
+    finally:
+        pool.close()
+        pool.join()
+
+    return summary
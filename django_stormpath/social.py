@@ -8,8 +8,9 @@ from stormpath.error import Error as StormpathError
 from stormpath.resources.provider import Provider
 from requests_oauthlib import OAuth2Session
 
-from .models import CLIENT, APPLICATION
+from .models import CLIENT
 from .backends import StormpathSocialBackend
+from .tenants import get_application
 
 SOCIAL_AUTH_BACKEND = 'django_stormpath.backends.StormpathSocialBackend'
 
@@ -98,14 +99,15 @@ def handle_social_callback(request, provider):
         raise RuntimeError('Error communicating with Autentication Provider: {}'.format(provider))
 
     params = {'provider': provider, 'access_token': access_token}
+    application = get_application()
 
     try:
-        account = APPLICATION.get_provider_account(**params)
+        account = application.get_provider_account(**params)
     except StormpathError as e:
         # We might be missing a social directory
         # First we look for one and see if it's already there
         # and just error out
-        for asm in APPLICATION.account_store_mappings:
+        for asm in application.account_store_mappings:
             if (getattr(asm.account_store, 'provider') and asm.account_store.provider.provider_id == provider):
                 raise e
 
@@ -113,7 +115,7 @@ def handle_social_callback(request, provider):
         # map it to the current application
         # and try authenticate again
         create_provider_directory(provider, abs_redirect_uri)
-        account = APPLICATION.get_provider_account(**params)
+        account = application.get_provider_account(**params)
 
     user = _get_django_user(account)
     user.backend = SOCIAL_AUTH_BACKEND
@@ -125,8 +127,9 @@ def handle_social_callback(request, provider):
 
 def create_provider_directory(provider, redirect_uri):
     """Helper function for creating a provider directory"""
+    application = get_application()
     dir = CLIENT.directories.create({
-        'name': APPLICATION.name + '-' + provider,
+        'name': application.name + '-' + provider,
         'provider': {
             'client_id': settings.STORMPATH_SOCIAL[provider.upper()]['client_id'],
             'client_secret': settings.STORMPATH_SOCIAL[provider.upper()]['client_secret'],
@@ -135,8 +138,8 @@ def create_provider_directory(provider, redirect_uri):
         },
     })
 
-    APPLICATION.account_store_mappings.create({
-        'application': APPLICATION,
+    application.account_store_mappings.create({
+        'application': application,
         'account_store': dir,
         'list_index': 99,
         'is_default_account_store': False,
@@ -0,0 +1,623 @@
+"""Mirroring of Stormpath accounts into the local database, and back.
+
+Accounts are fetched a page at a time and every page is written in its own
+transaction.  After each committed page the sync can save a checkpoint (the
+offset reached, counts and timings) so a crashed sync can be resumed where it
+stopped instead of starting over.
+
+Resuming relies on the order of the accounts collection: accounts created
+during the sync are appended and picked up, but accounts deleted before the
+checkpoint shift the later ones down, so a resumed sync may skip a few.  Run a
+full sync from time to time if accounts are deleted often.
+
+:class:`AccountPush` goes the other way, creating Stormpath accounts for local
+users that don't have one yet.
+"""
+
+import json
+import os
+from collections import namedtuple
+from logging import getLogger
+from multiprocessing.pool import ThreadPool
+from time import time
+from uuid import uuid4
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.forms import model_to_dict
+
+from stormpath.resources.account import Account
+
+from .helpers import bulk_update
+from .ratelimit import BATCH, priority
+from .tenants import get_application, get_group_prefix, local_group_name, tenant
+
+
+log = getLogger(__name__)
+
+# Stormpath doesn't return more than 100 items per page.
+MAX_BATCH_SIZE = 100
+
+# Expanded with every page of accounts, so group memberships come along.
+GROUPS_EXPANSION = 'groups(offset:0,limit:100)'
+
+# Account fields mirrored as they are, and their names in the API.
+RECORD_FIELDS = ('href', 'username', 'email', 'given_name', 'surname', 'middle_name')
+RECORD_PROPERTIES = ('href', 'username', 'email', 'givenName', 'surname', 'middleName')
+
+
+class Checkpoint(object):
+    """Sync state kept in a JSON file between runs."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None
+
+    def save(self, state):
+        # Write and rename, so a crash never leaves half a checkpoint.
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+# Stands in for the directory resource of a record: only its href is kept.
+DirectoryRef = namedtuple('DirectoryRef', 'href')
+
+
+class AccountRecord(object):
+    """The mirrored parts of an account, read from a raw page of accounts.
+
+    Records take a fraction of the memory of SDK resources, which keep their
+    client, all properties and expanded collections around.  They can be
+    passed to ``_mirror_data_from_stormpath_account`` in place of accounts.
+
+    ``group_names`` is None if the account has more groups than were
+    expanded.
+    """
+
+    __slots__ = RECORD_FIELDS + ('status', 'directory', 'custom_data', 'group_names')
+
+    STATUS_ENABLED = Account.STATUS_ENABLED
+    STATUS_DISABLED = Account.STATUS_DISABLED
+    STATUS_UNVERIFIED = Account.STATUS_UNVERIFIED
+
+    def __init__(self, data, prefix):
+        for field, name in zip(RECORD_FIELDS, RECORD_PROPERTIES):
+            setattr(self, field, data.get(name))
+        self.status = data.get('status')
+
+        directory = data.get('directory') or {}
+        self.directory = DirectoryRef(directory.get('href'))
+
+        # Only the custom data we mirror is kept.
+        custom_data = data.get('customData') or {}
+        self.custom_data = dict((k, v) for k, v in custom_data.items()
+            if k.startswith(prefix))
+
+        groups = data.get('groups') or {}
+        items = groups.get('items')
+        if items is not None and len(items) >= groups.get('size', 0):
+            self.group_names = tuple(g['name'] for g in items)
+        else:
+            self.group_names = None
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+
+class AccountSync(object):
+    """Create or update local users from the accounts of ``application``.
+
+    :param sync_groups: Mirror the application's groups and the accounts'
+        group memberships too.
+    :param batch_size: Accounts fetched and written per batch (at most 100).
+    :param limit: Stop after this many accounts.
+    :param dry_run: Only count what would be created and updated.
+    :param checkpoint: A :class:`Checkpoint` to save progress to.
+    :param progress: Called with the sync after every batch.
+    :param accounts: The accounts collection to sync, by default the
+        application's.  Used to sync a single account store.
+    :param start: Offset of the first account to sync.
+    :param end: Offset to stop at (exclusive).
+    """
+
+    def __init__(self, application, sync_groups=True, batch_size=MAX_BATCH_SIZE,
+            limit=None, dry_run=False, checkpoint=None, progress=None,
+            accounts=None, start=0, end=None):
+        self.application = application
+        self.accounts = accounts if accounts is not None else application.accounts
+        self.start = start
+        self.end = end
+        self.sync_groups = sync_groups
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.limit = limit
+        self.dry_run = dry_run
+        self.checkpoint = checkpoint
+        self.progress = progress
+
+        self.state = None
+        self.started = None
+        self.processed = 0
+        self.finished = False
+        self._group_ids = {}
+        self._custom_fields = {}
+
+    def _identity(self):
+        """What a checkpoint must have been saved by to be resumed here."""
+        return {
+            'application': self.application.href,
+            'accounts': self.accounts.href,
+            'start': self.start,
+            'end': self.end,
+        }
+
+    def _new_state(self):
+        state = self._identity()
+        state.update({
+            'offset': self.start,
+            'total': None,
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'skipped': 0,
+            'groups_done': False,
+            'timings': {},
+        })
+        return state
+
+    def _load_state(self, resume):
+        if resume and self.checkpoint is not None:
+            state = self.checkpoint.load()
+            identity = self._identity()
+            if state and all(state.get(k) == v for k, v in identity.items()):
+                return state
+            if state:
+                # Say partitions were computed differently this time.
+                log.warning('Not resuming from %s, it was saved by a sync of other '
+                    'accounts.', self.checkpoint.path)
+
+        return self._new_state()
+
+    def _timed(self, phase, started):
+        timings = self.state['timings']
+        timings[phase] = timings.get(phase, 0) + time() - started
+
+    @property
+    def rate(self):
+        """Accounts processed per second by this run."""
+        elapsed = time() - self.started
+        return self.processed / elapsed if elapsed > 0 else 0
+
+    @property
+    def eta(self):
+        """Estimated seconds left, or None if unknown."""
+        total = self.state['total']
+        if total is None or not self.rate:
+            return None
+
+        if self.end is not None:
+            total = min(total, self.end)
+        if self.limit is not None:
+            total = min(total, self.state['offset'] - self.processed + self.limit)
+
+        return max(total - self.state['offset'], 0) / self.rate
+
+    def _sync_groups(self):
+        sp_groups = [local_group_name(g.name, self.application) for g in self.application.groups]
+        db_groups = set(Group.objects.all().values_list('name', flat=True))
+        missing_from_db = set(sp_groups).difference(db_groups)
+        if missing_from_db and not self.dry_run:
+            Group.objects.bulk_create([Group(name=n) for n in missing_from_db])
+
+    def _fetch(self, offset, count):
+        # Read the raw page rather than SDK resources, and keep only records.
+        from .models import CLIENT
+
+        # Only expand what is mirrored.
+        expand = []
+        if self._custom_fields:
+            expand.append('customData')
+        if self.sync_groups:
+            expand.append(GROUPS_EXPANSION)
+        params = {'offset': offset, 'limit': count}
+        if expand:
+            params['expand'] = ','.join(expand)
+        page = CLIENT.data_store.executor.get(self.accounts.href, params=params)
+        if self.state['total'] is None:
+            self.state['total'] = page.get('size')
+
+        prefix = get_user_model().DJANGO_PREFIX
+        return [AccountRecord(a, prefix) for a in page.get('items', [])[:count]]
+
+    def _batches(self):
+        """Yield the records of the accounts to sync, a batch at a time."""
+        state = self.state
+        while self.limit is None or self.processed < self.limit:
+            count = self.batch_size
+            if self.limit is not None:
+                count = min(count, self.limit - self.processed)
+            if self.end is not None:
+                count = min(count, self.end - state['offset'])
+            if count <= 0:
+                self.finished = True
+                return
+
+            started = time()
+            records = self._fetch(state['offset'], count)
+            self._timed('fetch', started)
+            if not records:
+                self.finished = True
+                return
+
+            yield records
+
+            if len(records) < count:
+                self.finished = True
+                return
+
+    def _find_rows(self, records):
+        """Map account hrefs to the field values of the users mirroring them.
+
+        Also returns the hrefs of accounts whose email belongs to the user of
+        another account, which can't be mirrored.
+        """
+        UserModel = get_user_model()
+        rows = dict((r['href'], r) for r in
+            UserModel.objects.filter(href__in=[a.href for a in records]).values())
+
+        # Users mirrored before hrefs were tracked can only be matched by
+        # email.  Users bound to another account are never taken over.
+        missing = dict((a.email, a.href) for a in records if a.href not in rows)
+        conflicts = set()
+        if missing:
+            for row in UserModel.objects.filter(email__in=list(missing)).values():
+                if row['href'] is None:
+                    rows[missing[row['email']]] = row
+                else:
+                    log.warning('Not mirroring account %s, its email belongs to '
+                        'the user of another account.', missing[row['email']])
+                    conflicts.add(missing[row['email']])
+
+        return rows, conflicts
+
+    def _find_groups(self, rows):
+        """Map user pks to the ids of their groups."""
+        UserModel = get_user_model()
+        Membership = UserModel.groups.through
+        user_field = UserModel.groups.field.m2m_field_name() + '_id'
+        group_field = UserModel.groups.field.m2m_reverse_field_name() + '_id'
+
+        pk = UserModel._meta.pk.attname
+        groups = {}
+        for user_id, group_id in Membership.objects.filter(**{
+                user_field + '__in': [r[pk] for r in rows.values()],
+                }).values_list(user_field, group_field):
+            groups.setdefault(user_id, set()).add(group_id)
+
+        return groups
+
+    def _group_names(self, record):
+        if record.group_names is not None:
+            return record.group_names
+
+        # More groups than fit in the expansion.
+        from .models import CLIENT
+        return [g.name for g in CLIENT.accounts.get(record.href).groups]
+
+    def _changed(self, record, row, groups):
+        """Whether mirroring ``record`` would change the user in ``row``."""
+        UserModel = get_user_model()
+        for field in RECORD_FIELDS:
+            if record[field] != row[field]:
+                return True
+
+        if (record.status == record.STATUS_ENABLED) != row['is_active']:
+            return True
+
+        prefix = UserModel.DJANGO_PREFIX
+        for key, value in record.custom_data.items():
+            field = self._custom_fields.get(key[len(prefix):])
+            if field is None:
+                continue
+            try:
+                value = field.to_python(value)
+            except ValidationError:
+                return True
+            if value != row[field.attname]:
+                return True
+
+        if self.sync_groups:
+            if record.group_names is None:
+                return True
+            group_ids = set(self._group_ids[n] for n in record.group_names
+                if n in self._group_ids)
+            if group_ids != groups.get(row[UserModel._meta.pk.attname], set()):
+                return True
+
+        return False
+
+    def _apply(self, records):
+        rows, conflicts = self._find_rows(records)
+        groups = self._find_groups(rows) if self.sync_groups and rows else {}
+
+        # Models are only built for the users that are new or changed.
+        changed = [r for r in records if r.href not in conflicts and
+            (r.href not in rows or self._changed(r, rows[r.href], groups))]
+        created = len([r for r in changed if r.href not in rows])
+        updated = len(changed) - created
+        if self.dry_run:
+            return created, updated, len(conflicts)
+
+        UserModel = get_user_model()
+        with transaction.atomic():
+            for record in changed:
+                row = rows.get(record.href)
+                if row is None:
+                    user = UserModel()
+                    user.set_unusable_password()
+                else:
+                    user = UserModel(**row)
+                user._mirror_data_from_stormpath_account(record)
+                user._save_db_only()
+
+                if self.sync_groups:
+                    user.groups = [self._group_ids[n] for n in self._group_names(record)
+                        if n in self._group_ids]
+
+        return created, updated, len(conflicts)
+
+    def run(self, resume=False):
+        """Run the sync and return its final state.
+
+        :param resume: Continue from the checkpoint, if there is one for
+            this application.
+        """
+        self.state = state = self._load_state(resume)
+        state.setdefault('unchanged', 0)
+        state.setdefault('skipped', 0)
+        self.started = time()
+        self.processed = 0
+        self.finished = False
+
+        UserModel = get_user_model()
+        custom_fields = UserModel._custom_data_fields()
+        self._custom_fields = dict((f.name, f) for f in UserModel._meta.concrete_fields
+            if f.name in custom_fields)
+
+        with priority(BATCH):
+            if self.sync_groups:
+                if not state['groups_done']:
+                    started = time()
+                    self._sync_groups()
+                    state['groups_done'] = True
+                    self._timed('groups', started)
+                # By the names of the application's groups.
+                prefix = get_group_prefix(self.application)
+                self._group_ids = dict((name[len(prefix):], pk) for name, pk in
+                    Group.objects.filter(name__startswith=prefix).values_list('name', 'pk'))
+
+            for records in self._batches():
+                started = time()
+                created, updated, skipped = self._apply(records)
+                self._timed('write', started)
+
+                state['offset'] += len(records)
+                state['created'] += created
+                state['updated'] += updated
+                state['skipped'] += skipped
+                state['unchanged'] += len(records) - created - updated - skipped
+                self.processed += len(records)
+
+                if self.checkpoint is not None and not self.dry_run:
+                    started = time()
+                    self.checkpoint.save(state)
+                    self._timed('checkpoint', started)
+
+                if self.progress is not None:
+                    self.progress(self)
+
+        # A complete sync has nothing left to resume.
+        if self.finished and self.checkpoint is not None and not self.dry_run:
+            self.checkpoint.clear()
+
+        return state
+
+
+# Password hashes Stormpath can import, as Django encodes them.
+BCRYPT_PREFIXES = ('$2a$', '$2b$', '$2y$')
+
+
+def get_importable_password(encoded):
+    """Return ``encoded`` (a Django password hash) in Modular Crypt Format.
+
+    Stormpath only verifies bcrypt hashes the way Django does, so other
+    hashes (and unusable passwords) return None.
+    """
+    if encoded and encoded.startswith('bcrypt$'):
+        mcf = encoded[len('bcrypt$'):]
+        if mcf.startswith(BCRYPT_PREFIXES):
+            return mcf
+
+    return None
+
+
+class AccountPush(object):
+    """Create Stormpath accounts for local users without an href.
+
+    Users are read in chunks of ``chunk_size`` ordered by primary key, and
+    the accounts of a chunk are created by a pool of ``workers`` threads.
+    The hrefs are then written back with a single query per chunk.  Users
+    that failed are left without an href and recorded as JSON lines in the
+    ``failures`` file, if given, so running the push again retries them.
+
+    Every user is given an idempotency key before its account is created, so
+    a push interrupted between creating accounts and saving their hrefs
+    reuses those accounts when run again.  Accounts are created in the
+    application of the current tenant.  bcrypt password hashes are
+    imported; users with other hashes get accounts without a password and
+    have to reset it.
+    """
+
+    def __init__(self, workers=8, chunk_size=500, limit=None, failures=None,
+            progress=None):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.failures = failures
+        self.progress = progress
+
+        self.stats = {'pushed': 0, 'failed': 0, 'without_password': 0}
+        self.started = None
+        self.application = None
+
+    @property
+    def rate(self):
+        """Users pushed (or failed) per second."""
+        elapsed = time() - self.started
+        done = self.stats['pushed'] + self.stats['failed']
+        return done / elapsed if elapsed > 0 else 0
+
+    def _chunks(self):
+        UserModel = get_user_model()
+        users = (UserModel._default_manager.filter(href__isnull=True)
+            .order_by('pk').prefetch_related('groups', 'user_permissions'))
+
+        # Paginate by primary key, as failed users keep matching the filter.
+        last_pk = None
+        remaining = self.limit
+        while remaining is None or remaining > 0:
+            size = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+            chunk = users if last_pk is None else users.filter(pk__gt=last_pk)
+            chunk = list(chunk[:size])
+            if not chunk:
+                return
+
+            yield chunk
+            last_pk = chunk[-1].pk
+            if remaining is not None:
+                remaining -= len(chunk)
+
+    def _save_idempotency_keys(self, users):
+        keys = {}
+        for user in users:
+            if not user.idempotency_key:
+                user.idempotency_key = uuid4().hex
+                keys[user.pk] = {'idempotency_key': user.idempotency_key}
+
+        bulk_update(type(users[0]), keys)
+
+    def _push(self, item):
+        # Runs in a pool thread: only Stormpath is called here, everything
+        # read from the database was loaded beforehand.
+        user, data, password, group_names = item
+        # Tenants are per thread: create the account in the caller's.
+        with tenant(self.application), priority(BATCH):
+            try:
+                account = user._create_stormpath_user(data, password,
+                    password_format='mcf' if password else None,
+                    group_names=group_names)
+            except Exception as e:
+                return user, None, e
+
+        return user, account.href, None
+
+    def _record_failure(self, user, error):
+        self.stats['failed'] += 1
+        if self.failures is not None:
+            self.failures.write(json.dumps({
+                'pk': user.pk,
+                'email': user.email,
+                'status': getattr(error, 'status', None),
+                'error': str(error),
+            }) + '\n')
+
+    def run(self):
+        """Push all users without an href and return the counts."""
+        self.started = time()
+        self.application = get_application()
+        pool = ThreadPool(self.workers)
+        try:
+            for chunk in self._chunks():
+                self._save_idempotency_keys(chunk)
+
+                items = []
+                for user in chunk:
+                    password = get_importable_password(user.password)
+                    if password is None:
+                        self.stats['without_password'] += 1
+                    items.append((user, model_to_dict(user), password,
+                        [g.name for g in user.groups.all()]))
+
+                hrefs = {}
+                for user, href, error in pool.imap_unordered(self._push, items):
+                    if error is None:
+                        hrefs[user.pk] = {'href': href}
+                    else:
+                        self._record_failure(user, error)
+
+                bulk_update(type(chunk[0]), hrefs)
+                self.stats['pushed'] += len(hrefs)
+
+                if self.progress is not None:
+                    self.progress(self)
+        finally:
+            pool.close()
+            pool.join()
+
+        return self.stats
+
+
+def _backfill_batch(manager, hrefs_by_email):
+    taken = set(manager.filter(href__in=list(hrefs_by_email.values()))
+        .values_list('href', flat=True))
+
+    hrefs = {}
+    users = manager.filter(href=None, email__in=list(hrefs_by_email))
+    for pk, email in users.values_list('pk', 'email'):
+        href = hrefs_by_email[email]
+        if href not in taken:
+            hrefs[pk] = {'href': href}
+            taken.add(href)
+
+    bulk_update(manager.model, hrefs)
+    return len(hrefs)
+
+
+def backfill_hrefs(application, batch_size=500):
+    """Set the href of local users which don't have one, matching by email.
+
+    Walks the accounts of ``application`` once, a page at a time, instead of
+    searching for every user.  Returns the number of users updated.
+    """
+    manager = get_user_model()._default_manager
+    if not manager.filter(href=None).exists():
+        return 0
+
+    count = 0
+    hrefs_by_email = {}
+    with priority(BATCH):
+        for account in application.accounts:
+            hrefs_by_email[account.email] = account.href
+            if len(hrefs_by_email) >= batch_size:
+                count += _backfill_batch(manager, hrefs_by_email)
+                hrefs_by_email = {}
+
+    if hrefs_by_email:
+        count += _backfill_batch(manager, hrefs_by_email)
+
+    return count
@@ -0,0 +1,93 @@
+"""Background work for keeping mirrored users fresh.
+
+Work is run in a single daemon thread per process by default.  Projects with a
+task queue can set ``STORMPATH_PROFILE_REFRESH_SCHEDULER`` to the dotted path
+of a callable taking an account href and an application href, which should
+eventually call :func:`refresh_user` with both (for instance from a Celery
+task).
+"""
+
+from logging import getLogger
+from threading import Lock, Thread
+
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+
+from .ratelimit import BATCH, priority
+from .tenants import tenant
+
+
+log = getLogger(__name__)
+
+
+class BackgroundWorker(object):
+    """Runs queued callables one after the other in a daemon thread."""
+
+    def __init__(self, maxsize=1000):
+        self.queue = Queue(maxsize)
+        self._thread = None
+        self._lock = Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = Thread(target=self._run, name='stormpath-worker')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            close_old_connections()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                log.exception('Background Stormpath task %r failed.', func)
+            finally:
+                close_old_connections()
+                self.queue.task_done()
+
+    def schedule(self, func, *args, **kwargs):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except Full:
+            log.warning('Stormpath worker queue is full, dropping %r.', func)
+
+
+worker = BackgroundWorker()
+
+
+def refresh_user(account_href, application_href=None):
+    """Mirror the remote account (and its groups) into the local user.
+
+    :param application_href: The application of the tenant the user logged
+        in to, by default the current one.
+    """
+    from .backends import StormpathBackend, get_application
+
+    if application_href is None:
+        application_href = get_application().href
+
+    # Tenants are per thread, so set the user's one again here.
+    with tenant(application_href) as application, priority(BATCH):
+        account = application.accounts.get(account_href)
+        return StormpathBackend()._mirror_user(account)
+
+
+def schedule_refresh(account_href):
+    """Refresh the local user for ``account_href`` in the background."""
+    from .backends import get_application
+
+    application_href = get_application().href
+    scheduler = getattr(settings, 'STORMPATH_PROFILE_REFRESH_SCHEDULER', None)
+    if scheduler:
+        import_string(scheduler)(account_href, application_href)
+    else:
+        worker.schedule(refresh_user, account_href, application_href)
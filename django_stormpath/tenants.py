@@ -0,0 +1,167 @@
+"""Serving several Stormpath applications (tenants) from one deployment.
+
+By default everything talks to the application in ``STORMPATH_APPLICATION``.
+With ``StormpathTenantMiddleware`` every request is resolved to an
+application instead, which is then used by the backends, forms, views and
+model signals for the rest of the request.
+
+Requests are resolved by host with ``STORMPATH_TENANT_APPLICATIONS``, a dict
+of host names to application hrefs, or by the callable named in
+``STORMPATH_TENANT_RESOLVER``, which takes the request and returns an
+application href (or None for the default application).
+
+Application resources are kept in an LRU pool of
+``STORMPATH_TENANT_POOL_SIZE`` applications (100 by default).  They all
+share the one Stormpath client, and so its connections and cache.
+
+Local users are shared by all tenants: a user belongs to the account whose
+href it holds, and is never rebound to an account of another tenant.  Local
+groups are per tenant, see :func:`get_group_prefix`.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, local
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+DEFAULT_POOL_SIZE = 100
+
+_local = local()
+
+
+class ApplicationPool(object):
+    """The most recently used Stormpath applications, by href."""
+
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self._applications = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, href):
+        from .models import CLIENT
+
+        with self._lock:
+            application = self._applications.pop(href, None)
+            if application is None:
+                # Lazy: nothing is fetched until the application is used.
+                application = CLIENT.applications.get(href)
+            self._applications[href] = application
+
+            while len(self._applications) > self.size:
+                self._applications.popitem(last=False)
+
+        return application
+
+    def clear(self):
+        with self._lock:
+            self._applications.clear()
+
+    def __len__(self):
+        return len(self._applications)
+
+
+_pool = None
+
+
+def get_application_pool():
+    global _pool
+    if _pool is None:
+        _pool = ApplicationPool(getattr(settings, 'STORMPATH_TENANT_POOL_SIZE', DEFAULT_POOL_SIZE))
+    return _pool
+
+
+def resolve_by_host(request):
+    """Return the application href mapped to the request's host, if any."""
+    applications = getattr(settings, 'STORMPATH_TENANT_APPLICATIONS', None) or {}
+    return applications.get(request.get_host().split(':')[0])
+
+
+def resolve_application(request):
+    """Return the application serving ``request``, or None for the default."""
+    resolver = getattr(settings, 'STORMPATH_TENANT_RESOLVER', None)
+    resolver = import_string(resolver) if resolver else resolve_by_host
+
+    href = resolver(request)
+    if not href:
+        return None
+
+    return get_application_pool().get(href)
+
+
+def activate(application):
+    """Use ``application`` in the current thread until :func:`deactivate`."""
+    _local.application = application
+
+
+def deactivate():
+    """Go back to the default application in the current thread."""
+    _local.application = None
+
+
+@contextmanager
+def tenant(application):
+    """Use ``application`` (a resource or an href) for the duration of the block.
+
+    Useful in management commands and tasks, which don't go through the
+    middleware.
+    """
+    if not hasattr(application, 'href'):
+        application = get_application_pool().get(application)
+
+    previous = getattr(_local, 'application', None)
+    activate(application)
+    try:
+        yield application
+    finally:
+        activate(previous)
+
+
+def get_application():
+    """Return the Stormpath application of the current tenant.
+
+    That's the application activated for this thread, if any, and the one in
+    ``STORMPATH_APPLICATION`` otherwise.
+    """
+    application = getattr(_local, 'application', None)
+    if application is not None:
+        return application
+
+    from . import models
+    return models.APPLICATION
+
+
+def get_group_prefix(application=None):
+    """Prefix of the local groups mirroring the groups of ``application``.
+
+    Groups of the default application keep their names.  Those of other
+    tenants are prefixed with the application's id, so same-named groups of
+    different tenants, and the permissions given to them, stay apart.
+    """
+    from . import models
+
+    application = application or get_application()
+    default = models.APPLICATION
+    if default is None or application.href == default.href:
+        return ''
+
+    return '%s:' % application.href.rstrip('/').rsplit('/', 1)[-1]
+
+
+def local_group_name(name, application=None):
+    """Name of the local group mirroring the group ``name`` of ``application``."""
+    return get_group_prefix(application) + name
+
+
+def remote_group_name(name, application=None):
+    """Name of the group of ``application`` mirrored by the local group ``name``.
+
+    Returns None if the local group belongs to another tenant.
+    """
+    prefix = get_group_prefix(application)
+    if not name.startswith(prefix):
+        return None
+
+    return name[len(prefix):]
@@ -0,0 +1,127 @@
+"""Test helpers for keeping remote round trips under control.
+
+Performance regressions in this package usually show up as extra HTTP calls to
+Stormpath rather than CPU time.  These helpers work like Django's
+``assertNumQueries`` but count Stormpath API calls instead::
+
+    class MyTests(StormpathTestMixin, TestCase):
+
+        def test_login(self):
+            with self.assertNumStormpathCalls(3):
+                authenticate(username='jd@example.com', password='...')
+"""
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+from .client import remote_call
+
+
+class CaptureStormpathCalls(object):
+    """Context manager recording every Stormpath API call made inside it."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __iter__(self):
+        return iter(self.calls)
+
+    def __getitem__(self, index):
+        return self.calls[index]
+
+    def __len__(self):
+        return len(self.calls)
+
+    def _record(self, sender, method, url, params=None, status=None, **kwargs):
+        self.calls.append({
+            'method': method,
+            'url': url,
+            'params': params,
+            'status': status,
+        })
+
+    def __enter__(self):
+        self.calls = []
+        remote_call.connect(self._record, weak=False)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        remote_call.disconnect(self._record)
+
+
+class _AssertStormpathCallsContext(CaptureStormpathCalls):
+
+    def __init__(self, test_case, num, exact=True):
+        self.test_case = test_case
+        self.num = num
+        self.exact = exact
+        super(_AssertStormpathCallsContext, self).__init__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(_AssertStormpathCallsContext, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return
+
+        executed = len(self)
+        msg = '%d Stormpath calls made, %s%d expected\n%s' % (
+            executed, '' if self.exact else 'at most ', self.num,
+            '\n'.join('%s %s' % (c['method'], c['url']) for c in self.calls))
+
+        if self.exact:
+            self.test_case.assertEqual(executed, self.num, msg)
+        else:
+            self.test_case.assertLessEqual(executed, self.num, msg)
+
+
+class _AssertMaxQueriesContext(CaptureQueriesContext):
+
+    def __init__(self, test_case, num, connection):
+        self.test_case = test_case
+        self.num = num
+        super(_AssertMaxQueriesContext, self).__init__(connection)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super(_AssertMaxQueriesContext, self).__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return
+
+        executed = len(self)
+        self.test_case.assertLessEqual(executed, self.num,
+            '%d queries executed, at most %d expected\n%s' % (
+                executed, self.num,
+                '\n'.join(q['sql'] for q in self.captured_queries)))
+
+
+class StormpathTestMixin(object):
+    """Assertions for pinning the remote-call and query budget of code paths.
+
+    Mix into any ``unittest.TestCase`` subclass.
+    """
+
+    def assertNumStormpathCalls(self, num, func=None, *args, **kwargs):
+        """Assert that exactly ``num`` Stormpath API calls are made."""
+        context = _AssertStormpathCallsContext(self, num)
+        if func is None:
+            return context
+
+        with context:
+            func(*args, **kwargs)
+
+    def assertMaxStormpathCalls(self, num, func=None, *args, **kwargs):
+        """Assert that no more than ``num`` Stormpath API calls are made."""
+        context = _AssertStormpathCallsContext(self, num, exact=False)
+        if func is None:
+            return context
+
+        with context:
+            func(*args, **kwargs)
+
+    def assertMaxQueries(self, num, func=None, *args, **kwargs):
+        """Assert that no more than ``num`` database queries are executed."""
+        using = kwargs.pop('using', DEFAULT_DB_ALIAS)
+        context = _AssertMaxQueriesContext(self, num, connections[using])
+        if func is None:
+            return context
+
+        with context:
+            func(*args, **kwargs)
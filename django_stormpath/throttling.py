@@ -0,0 +1,147 @@
+"""Local throttling of password logins.
+
+Every password login is checked by Stormpath, so a credential stuffing burst
+costs one API call per attempt.  With ``STORMPATH_LOGIN_THROTTLE`` set,
+``StormpathBackend`` counts failed logins per username and per client IP in
+Django's cache, and rejects logins locally once either count reaches its limit
+within the window.  It also remembers rejected username / password pairs for
+a short while, so the same bad pair is turned down without asking Stormpath::
+
+    STORMPATH_LOGIN_THROTTLE = {
+        'username_limit': 5,            # failures per username and window
+        'ip_limit': 50,                 # failures per client IP and window
+        'window': 300,                  # seconds
+        'bad_credentials_timeout': 60,  # seconds a bad pair is remembered
+    }
+
+Client IPs are only known during requests going through
+``django_stormpath.middleware.StormpathLoginThrottleMiddleware``.
+"""
+
+import hashlib
+from threading import local
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.utils.crypto import salted_hmac
+from django.utils.encoding import force_bytes
+
+
+_local = local()
+
+
+def get_client_ip(request=None):
+    """Return the IP of the client making the current request, if known."""
+    if request is None:
+        return getattr(_local, 'client_ip', None)
+
+    header = getattr(settings, 'STORMPATH_CLIENT_IP_HEADER', 'REMOTE_ADDR')
+    value = request.META.get(header)
+    if not value:
+        return None
+
+    # X-Forwarded-For style headers list the client first.
+    return value.split(',')[0].strip()
+
+
+def set_client_ip(ip):
+    """Set the client IP of the current request (or None once it's over)."""
+    _local.client_ip = ip
+
+
+class SlidingWindowCounter(object):
+    """Counts events over the last ``window`` seconds in Django's cache.
+
+    Two fixed windows are kept, and the count of the previous one is weighted
+    by how much of it still overlaps the sliding window.
+    """
+
+    def __init__(self, prefix, window):
+        self.prefix = prefix
+        self.window = window
+
+    def _keys(self, ident, now):
+        ident = hashlib.sha1(force_bytes(ident)).hexdigest()
+        current = int(now // self.window)
+        return ('%s:%s:%d' % (self.prefix, ident, current),
+            '%s:%s:%d' % (self.prefix, ident, current - 1))
+
+    def count(self, ident):
+        now = time()
+        current, previous = self._keys(ident, now)
+        counts = cache.get_many([current, previous])
+        overlap = 1 - (now % self.window) / float(self.window)
+        return counts.get(current, 0) + counts.get(previous, 0) * overlap
+
+    def hit(self, ident):
+        current, _ = self._keys(ident, time())
+        cache.add(current, 0, self.window * 2)
+        try:
+            cache.incr(current)
+        except ValueError:
+            cache.set(current, 1, self.window * 2)
+
+    def reset(self, ident):
+        cache.delete_many(list(self._keys(ident, time())))
+
+
+class LoginThrottle(object):
+
+    def __init__(self, username_limit=5, ip_limit=50, window=300,
+            bad_credentials_timeout=60):
+        self.username_limit = username_limit
+        self.ip_limit = ip_limit
+        self.bad_credentials_timeout = bad_credentials_timeout
+        self.usernames = SlidingWindowCounter('stormpath:login:user', window)
+        self.ips = SlidingWindowCounter('stormpath:login:ip', window)
+
+    def _bad_credentials_key(self, username, password):
+        # Never store (even hashed) passwords as they are.
+        digest = salted_hmac('django_stormpath.throttling',
+            '%s\0%s' % (username, password)).hexdigest()
+        return 'stormpath:login:bad:%s' % digest
+
+    def check(self, username, password, ip=None):
+        """Decide whether a login may be checked with Stormpath.
+
+        Raises ``PermissionDenied`` if the username or IP is throttled, which
+        stops Django from trying other backends.  Returns False if the pair
+        is known to be bad, True otherwise.
+        """
+        username = username.lower()
+        if self.usernames.count(username) >= self.username_limit:
+            raise PermissionDenied('Too many failed logins for this user.')
+        if ip and self.ips.count(ip) >= self.ip_limit:
+            raise PermissionDenied('Too many failed logins from this address.')
+
+        if cache.get(self._bad_credentials_key(username, password)):
+            self._count_failure(username, ip)
+            return False
+
+        return True
+
+    def _count_failure(self, username, ip):
+        self.usernames.hit(username)
+        if ip:
+            self.ips.hit(ip)
+
+    def failed(self, username, password, ip=None):
+        """Record a login Stormpath rejected."""
+        username = username.lower()
+        cache.set(self._bad_credentials_key(username, password), True,
+            self.bad_credentials_timeout)
+        self._count_failure(username, ip)
+
+    def succeeded(self, username):
+        self.usernames.reset(username.lower())
+
+
+def get_login_throttle():
+    """Return the throttle configured by ``STORMPATH_LOGIN_THROTTLE``, if any."""
+    options = getattr(settings, 'STORMPATH_LOGIN_THROTTLE', None)
+    if not options:
+        return None
+
+    return LoginThrottle(**options)
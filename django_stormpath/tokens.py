@@ -0,0 +1,57 @@
+"""Local validation of Stormpath-issued OAuth access tokens.
+
+Stormpath signs the access tokens it issues with the secret of the API key
+that created them (HS256), so they can be verified without calling Stormpath.
+"""
+
+from logging import getLogger
+
+import jwt
+
+from django.conf import settings
+
+
+log = getLogger(__name__)
+
+ACCESS_TOKEN_TYPE = 'access'
+
+
+def get_bearer_token(request):
+    """Return the bearer token from the ``Authorization`` header, if any."""
+    auth = request.META.get('HTTP_AUTHORIZATION', '').split()
+    if len(auth) == 2 and auth[0].lower() == 'bearer':
+        return auth[1]
+
+    return None
+
+
+def validate_access_token(token, application_href=None):
+    """Validate a Stormpath access token by signature and expiry.
+
+    :param token: The encoded access token (JWT).
+    :param application_href: If given, the token must have been issued by
+        this Stormpath Application.
+
+    Returns the token claims if the token is valid, or None otherwise.  The
+    account href is in the ``sub`` claim.
+    """
+    try:
+        header = jwt.get_unverified_header(token)
+        claims = jwt.decode(token, settings.STORMPATH_SECRET, algorithms=['HS256'])
+    except jwt.InvalidTokenError as e:
+        log.debug(e)
+        return None
+
+    if header.get('stt') != ACCESS_TOKEN_TYPE:
+        return None
+
+    if header.get('kid', settings.STORMPATH_ID) != settings.STORMPATH_ID:
+        return None
+
+    if application_href and claims.get('iss') != application_href:
+        return None
+
+    if not claims.get('sub'):
+        return None
+
+    return claims
@@ -1,3 +1,4 @@
+import django
 from django.conf.urls import url
 from django.conf import settings
 
@@ -40,7 +41,11 @@ if getattr(settings, 'STORMPATH_ENABLE_LINKEDIN', False):
         url(r'^social-login/(?P<provider>linkedin)/', views.stormpath_social_login,
             name='stormpath_linkedin_social_login'),
     ]
-    
+if getattr(settings, 'STORMPATH_WEBHOOK_SECRET', None):
+    urlpatterns += [
+        url(r'^webhooks/stormpath/$', views.stormpath_webhook, name='stormpath_webhook'),
+    ]
+
 if django.VERSION[:2] < (1, 8):
     from django.conf.urls import patterns
     urlpatterns = patterns('django_stormpath.views', *urlpatterns)
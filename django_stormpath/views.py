@@ -1,18 +1,21 @@
 from django.conf import settings
 from django.shortcuts import redirect
-from django.http import HttpResponseBadRequest
+from django.http import HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
 from django.core.urlresolvers import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
 from stormpath.resources.provider import Provider
 
-from .models import APPLICATION
+from .tenants import get_application
 from .id_site import handle_id_site_callback
 from .social import get_authorization_url, handle_social_callback
+from .webhooks import InvalidSignature, apply_events, parse_events, verify_signature
 
 
 def stormpath_callback(request, provider):
     if provider == 'stormpath':
-        ret = APPLICATION.handle_stormpath_callback(
+        ret = get_application().handle_stormpath_callback(
                 request.build_absolute_uri())
         return handle_id_site_callback(request, ret)
 
@@ -21,14 +24,14 @@ def stormpath_callback(request, provider):
 
 
 def stormpath_id_site_login(request):
-    rdr = APPLICATION.build_id_site_redirect_url(
+    rdr = get_application().build_id_site_redirect_url(
             callback_uri=settings.STORMPATH_ID_SITE_CALLBACK_URI,
             state=request.GET.get('state'))
     return redirect(rdr)
 
 
 def stormpath_id_site_register(request):
-    rdr = APPLICATION.build_id_site_redirect_url(
+    rdr = get_application().build_id_site_redirect_url(
             callback_uri=settings.STORMPATH_ID_SITE_CALLBACK_URI,
             state=request.GET.get('state'),
             path="/#/register")
@@ -36,7 +39,7 @@ def stormpath_id_site_register(request):
 
 
 def stormpath_id_site_forgot_password(request):
-    rdr = APPLICATION.build_id_site_redirect_url(
+    rdr = get_application().build_id_site_redirect_url(
             callback_uri=settings.STORMPATH_ID_SITE_CALLBACK_URI,
             state=request.GET.get('state'),
             path="/#/forgot")
@@ -44,7 +47,7 @@ def stormpath_id_site_forgot_password(request):
 
 
 def stormpath_id_site_logout(request):
-    rdr = APPLICATION.build_id_site_redirect_url(
+    rdr = get_application().build_id_site_redirect_url(
             callback_uri=settings.STORMPATH_ID_SITE_CALLBACK_URI,
             state=request.GET.get('state'),
             logout=True)
@@ -61,3 +64,19 @@ def stormpath_social_login(request, provider):
 def stormpath_social_login_callback(request, provider):
     rdr = handle_social_callback(request, provider)
     return redirect(rdr)
+
+
+@csrf_exempt
+@require_POST
+def stormpath_webhook(request):
+    try:
+        verify_signature(request.body, request.META.get('HTTP_X_STORMPATH_SIGNATURE'))
+    except InvalidSignature:
+        return HttpResponseForbidden()
+
+    try:
+        events = parse_events(request.body)
+    except (ValueError, TypeError):
+        return HttpResponseBadRequest()
+
+    return JsonResponse({'processed': apply_events(events)})
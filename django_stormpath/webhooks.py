@@ -0,0 +1,318 @@
+"""Receiver for account and group membership events pushed by Stormpath.
+
+Events keep the local user table fresh without polling with
+``sync_accounts_from_stormpath``.  A request body is either a single event or
+an object with an ``events`` list, where every event looks like::
+
+    {
+        "id": "unique event id",
+        "type": "account.updated",
+        "data": {...}
+    }
+
+Supported types are ``account.created`` / ``account.updated`` (``data`` is the
+account, with at least its ``email``, ``username``, ``givenName`` and
+``surname`` and ideally with its ``customData`` expanded), ``account.deleted``
+(``data`` holds the account ``href``) and ``group_membership.created`` /
+``group_membership.deleted`` (``data`` holds the ``account`` and ``group``).
+
+Requests must be signed with an HMAC-SHA256 of the raw body, keyed with
+``STORMPATH_WEBHOOK_SECRET`` and sent hex encoded in the
+``X-Stormpath-Signature`` header.
+"""
+
+import hashlib
+import hmac
+import json
+from logging import getLogger
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_bytes
+
+from .directories import get_account_policy, get_directory_policy
+from .permissions import bump_permission_version
+from .sync import AccountRecord
+from .tenants import local_group_name
+
+
+log = getLogger(__name__)
+
+EVENT_ACCOUNT_CREATED = 'account.created'
+EVENT_ACCOUNT_UPDATED = 'account.updated'
+EVENT_ACCOUNT_DELETED = 'account.deleted'
+EVENT_GROUP_MEMBERSHIP_CREATED = 'group_membership.created'
+EVENT_GROUP_MEMBERSHIP_DELETED = 'group_membership.deleted'
+
+# The account properties without which a user can't be saved.
+ACCOUNT_REQUIRED_PROPERTIES = ('email', 'username', 'givenName', 'surname')
+
+# How long processed event ids are remembered for deduplication.
+SEEN_EVENT_TIMEOUT = 60 * 60 * 24
+
+
+class InvalidSignature(Exception):
+    pass
+
+
+class InvalidPayload(ValueError):
+    pass
+
+
+def verify_signature(body, signature):
+    """Raise :class:`InvalidSignature` unless ``signature`` matches ``body``."""
+    secret = getattr(settings, 'STORMPATH_WEBHOOK_SECRET', None)
+    if not secret or not signature:
+        raise InvalidSignature('Missing webhook secret or signature.')
+
+    if signature.startswith('sha256='):
+        signature = signature[len('sha256='):]
+
+    expected = hmac.new(force_bytes(secret), body, hashlib.sha256).hexdigest()
+    if not constant_time_compare(expected, signature):
+        raise InvalidSignature('Webhook signature does not match.')
+
+
+def _has_href(data, key=None):
+    if key is not None:
+        data = data.get(key) if isinstance(data, dict) else None
+    return isinstance(data, dict) and bool(data.get('href'))
+
+
+def _validate_event(event):
+    if not isinstance(event, dict):
+        raise InvalidPayload('Events must be objects.')
+    if not event.get('id') or not event.get('type') or not isinstance(event.get('data'), dict):
+        raise InvalidPayload('Events need an id, a type and a data object.')
+
+    kind, data = event['type'], event['data']
+    if kind in (EVENT_ACCOUNT_CREATED, EVENT_ACCOUNT_UPDATED, EVENT_ACCOUNT_DELETED):
+        if not _has_href(data):
+            raise InvalidPayload('Account events need the account href.')
+    if kind in (EVENT_ACCOUNT_CREATED, EVENT_ACCOUNT_UPDATED):
+        # Otherwise the user can't be saved, and the event would fail (and
+        # be redelivered) forever.
+        if not all(data.get(p) for p in ACCOUNT_REQUIRED_PROPERTIES):
+            raise InvalidPayload('Account events need the account %s.' %
+                ', '.join(ACCOUNT_REQUIRED_PROPERTIES))
+    if kind in (EVENT_GROUP_MEMBERSHIP_CREATED, EVENT_GROUP_MEMBERSHIP_DELETED):
+        if not _has_href(data, 'account') or not _has_href(data, 'group'):
+            raise InvalidPayload('Membership events need the account and group.')
+
+
+def parse_events(body):
+    """Return the events in ``body``, or raise ``ValueError`` if malformed."""
+    payload = json.loads(body.decode('utf-8'))
+    if isinstance(payload, dict) and 'events' in payload:
+        events = payload['events']
+        if not isinstance(events, list):
+            raise InvalidPayload('events must be a list.')
+    else:
+        events = [payload]
+
+    for event in events:
+        _validate_event(event)
+    return events
+
+
+def _seen_key(event_id):
+    return 'stormpath:webhook:%s' % event_id
+
+
+def _claim_events(events):
+    """Claim events for processing, dropping those claimed already.
+
+    Claiming with ``cache.add`` is atomic, so of concurrent deliveries of the
+    same event (or repeats within the body) only one is applied.
+    """
+    return [e for e in events
+        if cache.add(_seen_key(e['id']), True, SEEN_EVENT_TIMEOUT)]
+
+
+def _release_events(events):
+    """Let events be applied again, after applying them failed."""
+    cache.delete_many([_seen_key(e['id']) for e in events])
+
+
+def _resolve_accounts(accounts):
+    """Turn pushed account representations into ``AccountRecord`` objects.
+
+    Anything that needs Stormpath is fetched here, before the transaction:
+    custom data that wasn't expanded, and the (cached) policies of the
+    directories the accounts live in.
+    """
+    from .models import CLIENT
+
+    UserModel = get_user_model()
+    needs_custom_data = bool(UserModel._custom_data_fields())
+
+    records = {}
+    for href, data in accounts.items():
+        custom_data = data.get('customData') or {}
+        if needs_custom_data and custom_data.get('href') and set(custom_data) == set(['href']):
+            data = dict(data, customData=CLIENT.data_store.executor.get(custom_data['href']))
+
+        records[href] = AccountRecord(data, UserModel.DJANGO_PREFIX)
+        get_account_policy(records[href])
+
+    # Used for the is_active default of new users.
+    get_directory_policy()
+    return records
+
+
+def _apply_account_upserts(records):
+    """Mirror pushed account records into local users in bulk."""
+    UserModel = get_user_model()
+    users = dict((u.href, u) for u in UserModel.objects.filter(href__in=list(records)))
+
+    # Users created before we tracked hrefs can only be matched by email.
+    # Users bound to another account are never taken over.
+    missing = [r for h, r in records.items() if h not in users]
+    conflicts = set()
+    if missing:
+        emails = [r.email for r in missing]
+        for user in UserModel.objects.filter(email__in=emails):
+            for r in missing:
+                if r.email != user.email:
+                    continue
+                if user.href is None:
+                    users[r.href] = user
+                else:
+                    log.warning('Not mirroring account %s, its email belongs to '
+                        'the user of another account.', r.href)
+                    conflicts.add(r.href)
+
+    to_create = []
+    for href, account in records.items():
+        user = users.get(href)
+        if href in conflicts:
+            continue
+        elif user is None:
+            user = UserModel()
+            user._mirror_data_from_stormpath_account(account)
+            user.set_unusable_password()
+            to_create.append(user)
+        else:
+            user._mirror_data_from_stormpath_account(account)
+            user._save_db_only()
+
+    UserModel.objects.bulk_create(to_create)
+
+
+def _apply_group_memberships(added, removed):
+    """Add and remove (account href, group name) memberships in bulk."""
+    UserModel = get_user_model()
+    Membership = UserModel.groups.through
+    user_field = UserModel.groups.field.m2m_field_name() + '_id'
+    group_field = UserModel.groups.field.m2m_reverse_field_name() + '_id'
+
+    hrefs = set(h for h, _ in added | removed)
+    names = set(n for _, n in added | removed)
+    user_ids = dict(UserModel.objects.filter(href__in=list(hrefs)).values_list('href', 'pk'))
+
+    group_ids = dict(Group.objects.filter(name__in=list(names)).values_list('name', 'pk'))
+    missing_groups = [Group(name=n) for n in names if n not in group_ids]
+    if missing_groups:
+        # bulk_create doesn't send pre_save, so nothing is pushed back.
+        Group.objects.bulk_create(missing_groups)
+        group_ids = dict(Group.objects.filter(name__in=list(names)).values_list('name', 'pk'))
+
+    def pairs(memberships):
+        return set((user_ids[h], group_ids[n]) for h, n in memberships if h in user_ids)
+
+    removed_pairs = pairs(removed)
+    if removed_pairs:
+        q = Q()
+        for user_id, group_id in removed_pairs:
+            q |= Q(**{user_field: user_id, group_field: group_id})
+        Membership.objects.filter(q).delete()
+
+    added_pairs = pairs(added)
+    if added_pairs:
+        existing = set(Membership.objects.filter(**{
+            user_field + '__in': [u for u, _ in added_pairs],
+        }).values_list(user_field, group_field))
+        added_pairs -= existing
+        Membership.objects.bulk_create([
+            Membership(**{user_field: u, group_field: g})
+            for u, g in added_pairs
+        ])
+
+    # Bulk operations don't send m2m_changed, so invalidate by hand.
+    changed = set(u for u, _ in removed_pairs | added_pairs)
+    if changed:
+        bump_permission_version(changed)
+
+
+def _group_name(group):
+    """Name of the local group mirroring ``group``."""
+    if 'name' in group:
+        return local_group_name(group['name'])
+
+    from .models import CLIENT
+    return local_group_name(CLIENT.groups.get(group['href']).name)
+
+
+def apply_events(events):
+    """Apply ``events`` to the local database.
+
+    Events are collapsed first, so an account updated several times in one
+    batch is only written once, and then applied with bulk operations inside a
+    single transaction.  Everything needed from Stormpath is fetched before
+    the transaction starts.  Returns the number of events applied.
+    """
+    events = _claim_events(events)
+    try:
+        _apply_claimed_events(events)
+    except Exception:
+        _release_events(events)
+        raise
+
+    return len(events)
+
+
+def _apply_claimed_events(events):
+
+    upserts = {}
+    deletes = set()
+    added = set()
+    removed = set()
+
+    for event in events:
+        kind = event['type']
+        data = event['data']
+
+        if kind in (EVENT_ACCOUNT_CREATED, EVENT_ACCOUNT_UPDATED):
+            upserts[data['href']] = data
+            deletes.discard(data['href'])
+        elif kind == EVENT_ACCOUNT_DELETED:
+            deletes.add(data['href'])
+            upserts.pop(data['href'], None)
+        elif kind in (EVENT_GROUP_MEMBERSHIP_CREATED, EVENT_GROUP_MEMBERSHIP_DELETED):
+            membership = (data['account']['href'], _group_name(data['group']))
+            if kind == EVENT_GROUP_MEMBERSHIP_CREATED:
+                added.add(membership)
+                removed.discard(membership)
+            else:
+                removed.add(membership)
+                added.discard(membership)
+        else:
+            log.debug('Ignoring unsupported Stormpath event type %s.', kind)
+
+    records = _resolve_accounts(upserts) if upserts else {}
+
+    # No Stormpath calls from here on.
+    with transaction.atomic():
+        if records:
+            _apply_account_upserts(records)
+        if deletes:
+            # A queryset delete doesn't call StormpathUser.delete, so the
+            # (already deleted) remote accounts are left alone.
+            get_user_model().objects.filter(href__in=list(deletes)).delete()
+        if added or removed:
+            _apply_group_memberships(added, removed)
@@ -68,6 +68,7 @@ setup(
         'requests-oauthlib>=0.4.2',
         'stormpath>=2.1.8',
         'Django>=1.6',
+        'PyJWT>=1.4.0',
     ],
     extras_require = {
         'test': ['codacy-coverage', 'python-coveralls', 'coverage'],
@@ -1,17 +1,50 @@
-from time import sleep
+import hashlib
+import hmac
+import io
+import json
+import os
+import tempfile
+from threading import Event, Thread
+from time import sleep, time
 from uuid import uuid4
 
-from django.test import TestCase
-from django.db import IntegrityError, transaction
+from django import VERSION as DJANGO_VERSION
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
 from django.contrib.auth import get_user_model
-from django.core.exceptions import ObjectDoesNotExist
-from django.contrib.auth.models import Group
+from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.contrib.auth.models import Group, Permission
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.conf import settings
 
 import django_stormpath
-from django_stormpath.models import CLIENT
-from django_stormpath.backends import StormpathBackend
+from django_stormpath.models import CLIENT, get_default_is_active
+from django_stormpath.client import (identity_map, idempotent, RetryPolicy,
+    StormpathExecutor, get_retry_stats)
+from django_stormpath.backends import (StormpathBackend, StormpathSocialBackend,
+    StormpathAccessTokenBackend)
 from django_stormpath.forms import *
-
+from django_stormpath.id_site import handle_id_site_callback, ID_SITE_STATUS_AUTHENTICATED
+from django_stormpath.testing import StormpathTestMixin
+from django_stormpath.tasks import refresh_user
+from django_stormpath.directories import (clear_directory_policies, get_account_policy,
+    get_directory_policy)
+from django_stormpath.mirror import export_mirror, import_mirror, open_mirror
+from django_stormpath.reconcile import Reconciler
+from django_stormpath.sharding import _sync_partition, get_partitions
+from django_stormpath.middleware import StormpathTenantMiddleware
+from django_stormpath.tenants import (ApplicationPool, get_application, get_group_prefix,
+    local_group_name, remote_group_name, tenant)
+from django_stormpath.sync import (AccountPush, AccountRecord, AccountSync, Checkpoint,
+    backfill_hrefs, get_importable_password)
+from django_stormpath.ratelimit import BATCH, INTERACTIVE, RateLimiter, get_priority, priority
+from django_stormpath.views import stormpath_webhook
+from django_stormpath.management.commands.sync_accounts_from_stormpath import get_default_checkpoint
+from django_stormpath import last_login
+
+import jwt
 from pydispatch import dispatcher
 
 from stormpath.error import Error as StormpathError
@@ -31,20 +64,28 @@ def sleep_receiver_function(signal, sender, data, params):
 dispatcher.connect(sleep_receiver_function, signal=SIGNAL_RESOURCE_CREATED)
 
 
+scheduled_refreshes = []
+
+
+def record_refresh(account_href, application_href):
+    """Profile refresh scheduler used in tests instead of the worker thread."""
+    scheduled_refreshes.append((account_href, application_href))
+
+
 UserModel = get_user_model()
 
 
-class LiveTestBase(TestCase):
+class LiveTestMixin(object):
 
     def setUp(self):
-        super(LiveTestBase, self).setUp()
+        super(LiveTestMixin, self).setUp()
 
         self.prefix = 'stormpath-django-test-%s' % uuid4().hex
         self.app = CLIENT.applications.create({'name': self.prefix}, create_directory = True)
         django_stormpath.models.APPLICATION = self.app
 
     def tearDown(self):
-        super(LiveTestBase, self).tearDown()
+        super(LiveTestMixin, self).tearDown()
 
         for mapping in self.app.account_store_mappings:
             mapping.account_store.delete()
@@ -82,6 +123,14 @@ class LiveTestBase(TestCase):
         return user
 
 
+class LiveTestBase(LiveTestMixin, TestCase):
+    pass
+
+
+class LiveTransactionTestBase(LiveTestMixin, TransactionTestCase):
+    pass
+
+
 class TestUserAndGroups(LiveTestBase):
     def test_creating_a_user(self):
         user = self.create_django_user(
@@ -613,6 +662,108 @@ class TestUserAndGroups(LiveTestBase):
         self.assertFalse(user.check_password('invalidpassword'))
 
 
+class TestWritePath(LiveTestBase):
+    def test_creating_a_user_with_taken_email_raises_integrity_error(self):
+        self.create_django_user(email='john.doe@example.com')
+
+        with self.assertRaises(IntegrityError):
+            self.create_django_user(email='john.doe@example.com')
+
+        self.assertEqual(1, UserModel.objects.count())
+        self.assertEqual(1, len(self.app.accounts.search({'email': 'john.doe@example.com'})))
+
+    def test_creating_a_user_pushes_custom_data(self):
+        user = self.create_django_user()
+
+        a = self.app.accounts.get(user.href)
+        self.assertEqual(a.custom_data['spDjango_is_staff'], False)
+
+    def test_creating_a_user_stores_idempotency_key(self):
+        user = self.create_django_user()
+
+        a = self.app.accounts.get(user.href)
+        self.assertIsNotNone(user.idempotency_key)
+        self.assertEqual(a.custom_data['spDjango_idempotency_key'], user.idempotency_key)
+
+    def test_retried_create_reuses_account(self):
+        user = self.create_django_user(email='john.doe@example.com')
+        href = user.href
+
+        # Pretend the first attempt timed out after creating the account.
+        UserModel.objects.filter(pk=user.pk).delete()
+        user.pk = user.id = None
+        user.href = None
+        user.set_password('W00t123!W00t123!')
+        user.save()
+
+        self.assertEqual(user.href, href)
+        self.assertEqual(1, len(self.app.accounts.search({'email': 'john.doe@example.com'})))
+
+    def test_deleting_a_user_whose_account_is_gone(self):
+        user = self.create_django_user()
+        self.app.accounts.get(user.href).delete()
+
+        user.delete()
+
+        self.assertEqual(0, UserModel.objects.count())
+
+
+class TestSyncFields(StormpathTestMixin, LiveTestBase):
+    def setUp(self):
+        super(TestSyncFields, self).setUp()
+        UserModel.STORMPATH_SYNC_FIELDS = ['is_staff', 'is_superuser', 'is_admin']
+        UserModel.LOCAL_ONLY_FIELDS = ['is_admin']
+
+    def tearDown(self):
+        UserModel.STORMPATH_SYNC_FIELDS = None
+        UserModel.LOCAL_ONLY_FIELDS = []
+        super(TestSyncFields, self).tearDown()
+
+    def test_only_sync_fields_are_pushed(self):
+        self.assertEqual(set(['is_staff', 'is_superuser']), UserModel._custom_data_fields())
+
+        user = self.create_django_user(superuser=True)
+        user.is_admin = True
+        user.save()
+
+        a = self.app.accounts.get(user.href)
+        keys = [k for k in a.custom_data.keys() if k.startswith(UserModel.DJANGO_PREFIX)]
+        self.assertEqual(sorted(['spDjango_is_staff', 'spDjango_is_superuser',
+            'spDjango_idempotency_key']), sorted(keys))
+
+    def test_custom_data_is_not_fetched_without_sync_fields(self):
+        UserModel.STORMPATH_SYNC_FIELDS = []
+        user = self.create_django_user()
+        a = self.app.accounts.get(user.href)
+        a.email
+
+        with self.assertNumStormpathCalls(0):
+            self.assertEqual({}, UserModel._synced_custom_data(a))
+
+
+class TestPrefetchStormpath(StormpathTestMixin, LiveTestBase):
+    def test_accounts_are_attached_to_users(self):
+        for i in range(3):
+            self.create_django_user(email='prefetch%d@example.com' % i)
+
+        users = list(UserModel.objects.filter(email__startswith='prefetch')
+            .prefetch_stormpath(expand=['customData'], workers=2))
+
+        self.assertEqual(3, len(users))
+        with self.assertNumStormpathCalls(0):
+            for user in users:
+                self.assertEqual(user.email, user.stormpath_account.email)
+                self.assertEqual(False, user.stormpath_account.custom_data['spDjango_is_staff'])
+
+    def test_missing_accounts_are_none(self):
+        user = self.create_django_user()
+        self.app.accounts.get(user.href).delete()
+
+        user = UserModel.objects.prefetch_stormpath().get(pk=user.pk)
+
+        self.assertIsNone(user.stormpath_account)
+
+
 class TestDjangoUser(LiveTestBase):
     def test_creating_a_user(self):
         user = self.create_django_user(
@@ -875,3 +1026,1217 @@ class TestForms(LiveTestBase):
         self.assertTrue(is_valid)
         form.save()
         self.assertEqual(1, UserModel.objects.count())
+
+
+class TestRemoteCallBudgets(StormpathTestMixin, LiveTestBase):
+    """Pin the number of Stormpath calls and queries made by hot paths.
+
+    If one of these starts failing, a change added (or removed) a round trip:
+    update the budget and its breakdown.  The budgets assume the SDK's default
+    resource cache and warm directory policies, so every flow is run once
+    before it's measured.
+    """
+
+    # Assigning user.groups clears and re-adds them on Django 1.8, while
+    # later versions only diff the current memberships against the new ones.
+    GROUPS_ASSIGNMENT_QUERIES = 4 if DJANGO_VERSION < (1, 9) else 2
+
+    # Mirroring a known account: the user by href, the group names, the
+    # groups assignment and the update of the user.
+    MIRROR_QUERIES = 3 + GROUPS_ASSIGNMENT_QUERIES
+
+    # The application's groups and the account's groups, the account and its
+    # custom data being cached.
+    MIRROR_CALLS = 2
+
+    def create_account(self, email='budget@example.com'):
+        acc = self.app.accounts.create({
+            'email': email,
+            'given_name': 'John',
+            'surname': 'Doe',
+            'password': 'TestPassword123!',
+        })
+        g = self.app.groups.create({'name': 'budgetGroup'})
+        acc.add_group(g)
+        acc.save()
+
+        return acc
+
+    def test_login_budget(self):
+        acc = self.create_account()
+        b = StormpathBackend()
+        b.authenticate(acc.email, 'TestPassword123!')
+
+        # The login attempt, then mirroring.
+        with self.assertNumStormpathCalls(1 + self.MIRROR_CALLS), \
+                self.assertNumQueries(self.MIRROR_QUERIES):
+            user = b.authenticate(acc.email, 'TestPassword123!')
+
+        self.assertIsNotNone(user)
+
+    def test_social_login_budget(self):
+        acc = self.create_account()
+        b = StormpathSocialBackend()
+        b.authenticate(account=self.app.accounts.get(acc.href))
+
+        with self.assertNumStormpathCalls(self.MIRROR_CALLS), \
+                self.assertNumQueries(self.MIRROR_QUERIES):
+            user = b.authenticate(account=self.app.accounts.get(acc.href))
+
+        self.assertIsNotNone(user)
+
+    def test_id_site_callback_budget(self):
+        acc = self.create_account()
+        StormpathBackend().authenticate(acc.email, 'TestPassword123!')
+
+        request = RequestFactory().get('/')
+        SessionMiddleware().process_request(request)
+
+        class IdSiteResponse(object):
+            status = ID_SITE_STATUS_AUTHENTICATED
+            account = self.app.accounts.get(acc.href)
+
+        # Logging in saves last_login, which pushes the user to Stormpath:
+        # the account, the group lookup by name, the account's groups, the
+        # memberships save and the memberships.  Locally, the m2m fields read
+        # by model_to_dict, the group names and the savepointed update, plus
+        # the new session (a key check and a savepointed insert).
+        with self.assertNumStormpathCalls(self.MIRROR_CALLS + 5), \
+                self.assertNumQueries(self.MIRROR_QUERIES + 6 + 4):
+            response = handle_id_site_callback(request, IdSiteResponse())
+
+        self.assertEqual(302, response.status_code)
+
+    def test_user_create_budget(self):
+        get_default_is_active()
+
+        # The account, created with the right status right away; the user is
+        # inserted under a savepoint.
+        with self.assertNumStormpathCalls(1), self.assertNumQueries(3):
+            self.create_django_user(
+                email='john.doe@example.com',
+                given_name='John',
+                surname='Doe',
+                password='TestPassword123!',
+            )
+
+    def test_user_update_budget(self):
+        user = self.create_django_user(
+            email='john.doe@example.com',
+            given_name='John',
+            surname='Doe',
+            password='TestPassword123!',
+        )
+        user.surname = 'Smith'
+
+        # The custom data (the account is cached since its creation), the
+        # account save, the memberships save and the memberships.  Locally,
+        # the m2m fields read by model_to_dict, the group names and the
+        # savepointed update.
+        with self.assertNumStormpathCalls(4), self.assertNumQueries(6):
+            user.save()
+
+    def test_group_rename_budget(self):
+        g = Group.objects.create(name='budgetGroup')
+        g.name = 'renamedBudgetGroup'
+
+        # The group search and its save; the old name and the update.
+        with self.assertNumStormpathCalls(2), self.assertNumQueries(2):
+            g.save()
+
+        self.assertEqual(1, len(self.app.groups.search({'name': 'renamedBudgetGroup'})))
+
+
+class TestIdentityMap(StormpathTestMixin, LiveTestBase):
+    def test_resources_are_fetched_once(self):
+        acc = self.app.accounts.create({
+            'email': 'jd@example.com',
+            'given_name': 'John',
+            'surname': 'Doe',
+            'password': 'TestPassword123!',
+        })
+
+        with identity_map():
+            self.app.accounts.search({'email': acc.email})[0].href
+
+            with self.assertNumStormpathCalls(0):
+                self.app.accounts.search({'email': acc.email})[0].href
+
+    def test_writes_discard_memoized_resources(self):
+        acc = self.app.accounts.create({
+            'email': 'jd@example.com',
+            'given_name': 'John',
+            'surname': 'Doe',
+            'password': 'TestPassword123!',
+        })
+
+        with identity_map():
+            self.app.accounts.search({'email': acc.email})[0].href
+            acc.surname = 'Smith'
+            acc.save()
+
+            with self.assertNumStormpathCalls(1):
+                self.assertEqual('Smith', self.app.accounts.search({'email': acc.email})[0].surname)
+
+
+@override_settings(
+    STORMPATH_PROFILE_REFRESH_WINDOW=300,
+    STORMPATH_PROFILE_REFRESH_SCHEDULER='testapp.tests.record_refresh')
+class TestProfileRefreshWindow(StormpathTestMixin, LiveTestBase):
+    def setUp(self):
+        super(TestProfileRefreshWindow, self).setUp()
+        cache.clear()
+        del scheduled_refreshes[:]
+
+    def test_returning_user_is_not_refreshed_within_window(self):
+        acc = self.app.accounts.create({
+            'email': 'jd@example.com',
+            'given_name': 'John',
+            'surname': 'Doe',
+            'password': 'TestPassword123!',
+        })
+
+        b = StormpathBackend()
+        b.authenticate(acc.email, 'TestPassword123!')
+
+        acc.surname = 'Smith'
+        acc.save()
+
+        with self.assertNumStormpathCalls(1):
+            user = b.authenticate(acc.email, 'TestPassword123!')
+
+        self.assertEqual('Doe', user.surname)
+        self.assertEqual([], scheduled_refreshes)
+
+    def test_stale_user_is_refreshed_in_the_background(self):
+        acc = self.app.accounts.create({
+            'email': 'jd@example.com',
+            'given_name': 'John',
+            'surname': 'Doe',
+            'password': 'TestPassword123!',
+        })
+
+        b = StormpathBackend()
+        b.authenticate(acc.email, 'TestPassword123!')
+
+        acc.surname = 'Smith'
+        acc.save()
+        cache.clear()
+
+        user = b.authenticate(acc.email, 'TestPassword123!')
+        self.assertEqual('Doe', user.surname)
+        self.assertEqual([(acc.href, self.app.href)], scheduled_refreshes)
+
+        refresh_user(acc.href, self.app.href)
+        self.assertEqual('Smith', UserModel.objects.get(href=acc.href).surname)
+
+
+@override_settings(STORMPATH_WEBHOOK_SECRET='webhook-secret')
+class TestWebhooks(StormpathTestMixin, LiveTestBase):
+    def setUp(self):
+        super(TestWebhooks, self).setUp()
+        cache.clear()
+
+    def post_events(self, events, secret='webhook-secret'):
+        body = json.dumps({'events': events}).encode('utf-8')
+        signature = hmac.new(secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+        request = RequestFactory().post('/webhooks/stormpath/', body,
+            content_type='application/json', HTTP_X_STORMPATH_SIGNATURE=signature)
+
+        return stormpath_webhook(request)
+
+    def test_invalid_signature_is_rejected(self):
+        response = self.post_events([], secret='wrong')
+        self.assertEqual(403, response.status_code)
+
+    def test_account_events_are_applied(self):
+        href = 'https://api.stormpath.com/v1/accounts/webhook'
+        account = {
+            'href': href,
+            'email': 'jd@example.com',
+            'username': 'jd@example.com',
+            'givenName': 'John',
+            'surname': 'Doe',
+            'middleName': None,
+            'status': 'ENABLED',
+            'customData': {'href': href + '/customData', 'spDjango_is_staff': True},
+        }
+
+        membership = {'id': '2', 'type': 'group_membership.created', 'data': {
+            'account': {'href': href},
+            'group': {'href': 'https://api.stormpath.com/v1/groups/g', 'name': 'testGroup'},
+        }}
+
+        # Policies are cached; the first lookup happens before the transaction.
+        get_directory_policy()
+        with self.assertNumStormpathCalls(0):
+            response = self.post_events([
+                {'id': '1', 'type': 'account.created', 'data': account},
+                membership,
+            ])
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'processed': 2}, json.loads(response.content.decode('utf-8')))
+        user = UserModel.objects.get(href=href)
+        self.assertEqual('John', user.given_name)
+        self.assertTrue(user.is_staff)
+        self.assertEqual(1, user.groups.filter(name='testGroup').count())
+
+        response = self.post_events([
+            membership,
+            {'id': '3', 'type': 'account.deleted', 'data': {'href': href}},
+        ])
+        self.assertEqual({'processed': 1}, json.loads(response.content.decode('utf-8')))
+        self.assertEqual(0, UserModel.objects.filter(href=href).count())
+
+    def test_users_of_other_accounts_are_not_taken_over(self):
+        user = UserModel(email='jd@example.com', username='jd@example.com',
+            given_name='John', surname='Doe', href='https://api.stormpath.com/v1/accounts/first')
+        user.set_unusable_password()
+        user._save_db_only()
+
+        response = self.post_events([{'id': '1', 'type': 'account.created', 'data': {
+            'href': 'https://api.stormpath.com/v1/accounts/second',
+            'email': 'jd@example.com',
+            'username': 'jd@example.com',
+            'givenName': 'Other',
+            'surname': 'Doe',
+            'status': 'ENABLED',
+        }}])
+
+        self.assertEqual(200, response.status_code)
+        user = UserModel.objects.get(email='jd@example.com')
+        self.assertEqual('https://api.stormpath.com/v1/accounts/first', user.href)
+        self.assertEqual('John', user.given_name)
+
+    def test_failed_events_can_be_redelivered(self):
+        event = {'id': '1', 'type': 'group_membership.created', 'data': {
+            'account': {'href': 'https://api.stormpath.com/v1/accounts/webhook'},
+            'group': {'href': 'https://api.stormpath.com/v1/groups/missing'},
+        }}
+
+        # The group's name can't be fetched.
+        with self.assertRaises(StormpathError):
+            self.post_events([event])
+        self.assertTrue(cache.add('stormpath:webhook:1', True))
+
+    def test_accounts_without_required_properties_are_rejected(self):
+        account = {
+            'href': 'https://api.stormpath.com/v1/accounts/webhook',
+            'email': 'jd@example.com',
+            'username': 'jd@example.com',
+            'givenName': 'John',
+            'surname': 'Doe',
+            'status': 'ENABLED',
+        }
+
+        for name in ('email', 'username', 'givenName', 'surname'):
+            data = dict(account)
+            del data[name]
+            response = self.post_events([{'id': '1', 'type': 'account.created', 'data': data}])
+            self.assertEqual(400, response.status_code)
+
+        # Rejected events are never claimed, so they aren't applied either.
+        self.assertTrue(cache.add('stormpath:webhook:1', True))
+        self.assertEqual(0, UserModel.objects.filter(href=account['href']).count())
+
+    def test_malformed_payloads_are_rejected(self):
+        for events in (
+            'not a list',
+            [{'type': 'account.created', 'data': {'href': 'x'}}],
+            [{'id': '1', 'data': {'href': 'x'}}],
+            [{'id': '1', 'type': 'account.created'}],
+            [{'id': '1', 'type': 'account.created', 'data': {}}],
+            [{'id': '1', 'type': 'group_membership.created', 'data': {'account': {'href': 'x'}}}],
+        ):
+            self.assertEqual(400, self.post_events(events).status_code)
+
+
+class TestAccessTokenBackend(StormpathTestMixin, LiveTestBase):
+    def setUp(self):
+        super(TestAccessTokenBackend, self).setUp()
+        cache.clear()
+
+    def create_token(self, sub, expires_in=3600, secret=None, stt='access'):
+        now = int(time())
+        return jwt.encode({
+            'jti': uuid4().hex,
+            'iat': now,
+            'iss': self.app.href,
+            'sub': sub,
+            'exp': now + expires_in,
+        }, secret or settings.STORMPATH_SECRET, algorithm='HS256', headers={
+            'kid': settings.STORMPATH_ID,
+            'stt': stt,
+        })
+
+    def test_valid_token_needs_no_remote_calls(self):
+        user = self.create_django_user(
+            email='john.doe@example.com',
+            given_name='John',
+            surname='Doe',
+            password='TestPassword123!',
+        )
+        token = self.create_token(user.href)
+
+        with self.assertNumStormpathCalls(0):
+            self.assertEqual(user, StormpathAccessTokenBackend().authenticate(access_token=token))
+            self.assertEqual(user, StormpathAccessTokenBackend().authenticate(access_token=token))
+
+    def test_invalid_tokens_are_rejected(self):
+        user = self.create_django_user(
+            email='john.doe@example.com',
+            given_name='John',
+            surname='Doe',
+            password='TestPassword123!',
+        )
+        b = StormpathAccessTokenBackend()
+
+        self.assertIsNone(b.authenticate(access_token=self.create_token(user.href, expires_in=-10)))
+        self.assertIsNone(b.authenticate(access_token=self.create_token(user.href, secret='wrong')))
+        self.assertIsNone(b.authenticate(access_token=self.create_token(user.href, stt='refresh')))
+        self.assertIsNone(b.authenticate(access_token='garbage'))
+
+
+@override_settings(STORMPATH_LOGIN_THROTTLE={
+    'username_limit': 3,
+    'ip_limit': 5,
+    'window': 60,
+    'bad_credentials_timeout': 60,
+})
+class TestLoginThrottle(StormpathTestMixin, LiveTestBase):
+    def setUp(self):
+        super(TestLoginThrottle, self).setUp()
+        cache.clear()
+        self.create_django_user(email='john.doe@example.com', password='TestPassword123!')
+
+    def test_known_bad_credentials_are_rejected_locally(self):
+        backend = StormpathBackend()
+        self.assertIsNone(backend.authenticate('john.doe@example.com', 'wrong'))
+
+        with self.assertNumStormpathCalls(0):
+            self.assertIsNone(backend.authenticate('john.doe@example.com', 'wrong'))
+
+    def test_username_is_throttled_after_failures(self):
+        backend = StormpathBackend()
+        for i in range(3):
+            self.assertIsNone(backend.authenticate('john.doe@example.com', 'wrong%d' % i))
+
+        with self.assertNumStormpathCalls(0):
+            with self.assertRaises(PermissionDenied):
+                backend.authenticate('JOHN.DOE@example.com', 'TestPassword123!')
+
+    def test_ip_is_throttled_after_failures(self):
+        backend = StormpathBackend()
+        request = RequestFactory().post('/login/', REMOTE_ADDR='10.0.0.1')
+        for i in range(5):
+            backend.authenticate('%d@example.com' % i, 'wrong', request=request)
+
+        with self.assertNumStormpathCalls(0):
+            with self.assertRaises(PermissionDenied):
+                backend.authenticate('john.doe@example.com', 'TestPassword123!', request=request)
+
+        # Other clients can still log in.
+        self.assertIsNotNone(backend.authenticate('john.doe@example.com', 'TestPassword123!'))
+
+    def test_successful_login_resets_username_failures(self):
+        backend = StormpathBackend()
+        for i in range(2):
+            backend.authenticate('john.doe@example.com', 'wrong%d' % i)
+
+        self.assertIsNotNone(backend.authenticate('john.doe@example.com', 'TestPassword123!'))
+        self.assertIsNone(backend.authenticate('john.doe@example.com', 'wrong2'))
+        self.assertIsNotNone(backend.authenticate('john.doe@example.com', 'TestPassword123!'))
+
+
+class TestPermissionCache(LiveTestBase):
+    def setUp(self):
+        super(TestPermissionCache, self).setUp()
+        cache.clear()
+
+    def test_permissions_are_cached_across_instances(self):
+        user = self.create_django_user(
+            email='john.doe@example.com',
+            given_name='John',
+            surname='Doe',
+            password='TestPassword123!',
+        )
+        g = Group.objects.create(name='testGroup')
+        g.permissions.add(Permission.objects.get(codename='add_group'))
+        user.groups.add(g)
+
+        b = StormpathBackend()
+        self.assertTrue(b.has_perm(UserModel.objects.get(pk=user.pk), 'auth.add_group'))
+
+        fresh = UserModel.objects.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(b.has_perm(fresh, 'auth.add_group'))
+
+    def test_membership_changes_invalidate_the_cache(self):
+        user = self.create_django_user(
+            email='john.doe@example.com',
+            given_name='John',
+            surname='Doe',
+            password='TestPassword123!',
+        )
+        g = Group.objects.create(name='testGroup')
+        g.permissions.add(Permission.objects.get(codename='add_group'))
+        user.groups.add(g)
+
+        b = StormpathBackend()
+        self.assertTrue(b.has_perm(UserModel.objects.get(pk=user.pk), 'auth.add_group'))
+
+        user.groups.remove(g)
+        self.assertFalse(b.has_perm(UserModel.objects.get(pk=user.pk), 'auth.add_group'))
+
+        user.groups.add(g)
+        self.assertTrue(b.has_perm(UserModel.objects.get(pk=user.pk), 'auth.add_group'))
+
+        g.permissions.clear()
+        self.assertFalse(b.has_perm(UserModel.objects.get(pk=user.pk), 'auth.add_group'))
+
+    def test_demoted_superusers_lose_their_permissions(self):
+        user = self.create_django_user(superuser=True)
+
+        b = StormpathBackend()
+        self.assertTrue(b.has_perm(UserModel.objects.get(pk=user.pk), 'auth.add_group'))
+
+        # Bulk updates (as done by syncs and imports) don't call save().
+        UserModel.objects.filter(pk=user.pk).update(is_superuser=False)
+        self.assertFalse(b.has_perm(UserModel.objects.get(pk=user.pk), 'auth.add_group'))
+
+        UserModel.objects.filter(pk=user.pk).update(is_superuser=True)
+        self.assertTrue(b.has_perm(UserModel.objects.get(pk=user.pk), 'auth.add_group'))
+
+
+class TestDebouncedLastLogin(StormpathTestMixin, LiveTestBase):
+    def test_last_login_is_buffered_and_flushed_in_bulk(self):
+        users = [self.create_django_user() for _ in range(2)]
+
+        with self.assertNumStormpathCalls(0), self.assertNumQueries(0):
+            for user in users:
+                last_login.update_last_login(sender=UserModel, user=user)
+
+        with self.assertNumStormpathCalls(0), self.assertNumQueries(1):
+            last_login.buffer.flush()
+
+        for user in users:
+            self.assertEqual(user.last_login, UserModel.objects.get(pk=user.pk).last_login)
+
+    def test_timer_flushes_close_their_connections(self):
+        closed = []
+
+        def flush():
+            connection.ensure_connection()
+            last_login.LastLoginBuffer()._flush_from_timer()
+            closed.append(connection.connection is None)
+
+        thread = Thread(target=flush)
+        thread.start()
+        thread.join()
+
+        self.assertEqual([True], closed)
+
+
+@override_settings(STORMPATH_COALESCE_WRITES=True)
+class TestWriteCoalescing(StormpathTestMixin, LiveTransactionTestBase):
+    def test_saves_in_a_transaction_are_pushed_once(self):
+        user = self.create_django_user(
+            email='john.doe@example.com',
+            given_name='John',
+            surname='Doe',
+            password='TestPassword123!',
+        )
+
+        with transaction.atomic():
+            with self.assertNumStormpathCalls(0):
+                user.surname = 'Smith'
+                user.save()
+                user.given_name = 'Jane'
+                user.save()
+
+        a = self.app.accounts.get(user.href)
+        self.assertEqual('Jane', a.given_name)
+        self.assertEqual('Smith', a.surname)
+
+    def test_superuser_is_created_with_one_write(self):
+        # Load the directory policy, used for the is_active default.
+        get_default_is_active()
+
+        with self.assertNumStormpathCalls(1):
+            user = self.create_django_user(
+                superuser=True,
+                email='john.doe@example.com',
+                given_name='John',
+                surname='Doe',
+                password='TestPassword123!',
+            )
+
+        a = self.app.accounts.get(user.href)
+        self.assertEqual(user.href, a.href)
+        self.assertEqual(a.custom_data['spDjango_is_superuser'], True)
+        self.assertIsNotNone(StormpathBackend().authenticate('john.doe@example.com', 'TestPassword123!'))
+
+    def test_failed_create_leaves_no_local_user(self):
+        with self.assertRaises(StormpathError):
+            self.create_django_user(email='john.doe@example.com', password='invalid')
+
+        self.assertEqual(0, UserModel.objects.count())
+
+
+class FailingError(StormpathError):
+    def __init__(self, status):
+        self.status = status
+
+
+class FlakyExecutor(object):
+    """Fails with the given statuses before succeeding."""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def _respond(self, *args, **kwargs):
+        self.calls += 1
+        if self.statuses:
+            raise FailingError(self.statuses.pop(0))
+        return {'href': 'https://api.stormpath.com/v1/accounts/x'}
+
+    get = post = delete = _respond
+
+
+class RecordingRetryPolicy(RetryPolicy):
+    def __init__(self, *args, **kwargs):
+        super(RecordingRetryPolicy, self).__init__(*args, **kwargs)
+        self.delays = []
+
+    def wait(self, delay):
+        self.delays.append(delay)
+
+
+class TestRetryPolicy(SimpleTestCase):
+    url = 'https://api.stormpath.com/v1/accounts/x'
+
+    def executor(self, *statuses, **kwargs):
+        self.policy = RecordingRetryPolicy(**kwargs)
+        self.inner = FlakyExecutor(*statuses)
+        return StormpathExecutor(self.inner, retry_policy=self.policy)
+
+    def test_throttled_calls_are_retried(self):
+        executor = self.executor(429, 429)
+
+        executor.post(self.url, {})
+
+        self.assertEqual(3, self.inner.calls)
+        self.assertEqual(2, len(self.policy.delays))
+
+    def test_server_errors_are_retried_for_idempotent_calls_only(self):
+        executor = self.executor(503)
+        executor.get(self.url)
+        self.assertEqual(2, self.inner.calls)
+
+        executor = self.executor(503)
+        with self.assertRaises(StormpathError):
+            executor.post(self.url, {})
+        self.assertEqual(1, self.inner.calls)
+
+        executor = self.executor(503)
+        with idempotent():
+            executor.post(self.url, {})
+        self.assertEqual(2, self.inner.calls)
+
+    def test_client_errors_are_not_retried(self):
+        executor = self.executor(400)
+
+        with self.assertRaises(StormpathError):
+            executor.get(self.url)
+
+        self.assertEqual(1, self.inner.calls)
+
+    def test_retries_are_bounded(self):
+        executor = self.executor(429, 429, 429, max_retries=2)
+        exhausted = get_retry_stats()['exhausted']
+
+        with self.assertRaises(StormpathError):
+            executor.get(self.url)
+
+        self.assertEqual(3, self.inner.calls)
+        self.assertEqual(exhausted + 1, get_retry_stats()['exhausted'])
+
+    def test_backoff_is_capped_and_jittered(self):
+        policy = RetryPolicy(base_delay=1, max_delay=5)
+
+        for attempt in range(1, 10):
+            delay = policy.get_delay(attempt)
+            self.assertTrue(0 <= delay <= min(5, 2 ** (attempt - 1)))
+
+    def test_retry_after_is_honored(self):
+        policy = RetryPolicy(max_delay=5)
+
+        self.assertEqual(3, policy.get_delay(1, retry_after=3))
+        self.assertEqual(5, policy.get_delay(1, retry_after=60))
+
+
+class TestRateLimiter(SimpleTestCase):
+    def limiter(self, **kwargs):
+        return RateLimiter(key_prefix='stormpath:rate:%s' % uuid4().hex, **kwargs)
+
+    def test_batch_calls_leave_reserved_capacity_alone(self):
+        limiter = self.limiter(rate=4, reserved=0.5)
+
+        self.assertTrue(limiter._take(limiter.batch_rate))
+        self.assertTrue(limiter._take(limiter.batch_rate))
+        self.assertFalse(limiter._take(limiter.batch_rate))
+
+        self.assertTrue(limiter._take(limiter.rate))
+        self.assertTrue(limiter._take(limiter.rate))
+        self.assertFalse(limiter._take(limiter.rate))
+
+    def test_interactive_calls_wait_at_most_max_wait(self):
+        limiter = self.limiter(rate=1, max_wait=0)
+
+        self.assertTrue(limiter.acquire(INTERACTIVE))
+        self.assertFalse(limiter.acquire(INTERACTIVE))
+
+    def test_priority_is_scoped_to_the_block(self):
+        self.assertEqual(INTERACTIVE, get_priority())
+        with priority(BATCH):
+            self.assertEqual(BATCH, get_priority())
+        self.assertEqual(INTERACTIVE, get_priority())
+
+
+class SlowExecutor(object):
+    def __init__(self):
+        self.calls = 0
+        self.release = Event()
+
+    def get(self, url, params=None):
+        self.calls += 1
+        self.release.wait()
+        return {'href': url, 'items': []}
+
+    def post(self, url, *args, **kwargs):
+        return {'href': url}
+
+
+class TestSingleflight(SimpleTestCase):
+    url = 'https://api.stormpath.com/v1/accounts/x'
+
+    def fetch_concurrently(self, executor, threads=5):
+        results = []
+
+        def fetch():
+            results.append(executor.get(self.url))
+
+        workers = [Thread(target=fetch) for _ in range(threads)]
+        for w in workers:
+            w.start()
+
+        # Wait for everybody to join the first thread's call.
+        flights = django_stormpath.client._flights
+        while sum(f.followers for f in list(flights.values())) < threads - 1:
+            sleep(0.01)
+
+        executor.executor.release.set()
+        for w in workers:
+            w.join()
+
+        return results
+
+    def test_concurrent_gets_share_one_call(self):
+        executor = StormpathExecutor(SlowExecutor())
+
+        results = self.fetch_concurrently(executor)
+
+        self.assertEqual(1, executor.executor.calls)
+        self.assertEqual(5, len(results))
+        self.assertTrue(all(r == results[0] for r in results))
+        # Everybody gets their own copy.
+        self.assertEqual(5, len(set(id(r) for r in results)))
+
+    def test_gets_after_a_write_dont_join_earlier_calls(self):
+        inner = SlowExecutor()
+        executor = StormpathExecutor(inner)
+
+        first = Thread(target=executor.get, args=(self.url,))
+        first.start()
+        while not django_stormpath.client._flights:
+            sleep(0.01)
+
+        executor.post(self.url, {})
+        second = Thread(target=executor.get, args=(self.url,))
+        second.start()
+        while len(django_stormpath.client._flights) < 2:
+            sleep(0.01)
+
+        inner.release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual(2, inner.calls)
+
+
+class TestDirectoryPolicies(StormpathTestMixin, LiveTestBase):
+    def setUp(self):
+        super(TestDirectoryPolicies, self).setUp()
+        clear_directory_policies()
+
+        self.directory = CLIENT.directories.create({'name': self.prefix + '-verified'})
+        self.app.account_store_mappings.create({
+            'application': self.app,
+            'account_store': self.directory,
+            'list_index': 99,
+            'is_default_account_store': False,
+            'is_default_group_store': False,
+        })
+        self.directory.account_creation_policy.verification_email_status = 'ENABLED'
+        self.directory.account_creation_policy.save()
+
+    def test_policy_of_the_account_directory(self):
+        account = self.directory.accounts.create({
+            'given_name': 'John',
+            'surname': 'Doe',
+            'email': 'john.doe@example.com',
+            'password': 'TestPassword123!',
+        })
+
+        self.assertFalse(get_directory_policy().verification_required)
+        self.assertTrue(get_account_policy(account).verification_required)
+
+        account.status = account.STATUS_ENABLED
+        user = UserModel()
+        user._mirror_data_from_stormpath_account(account)
+        self.assertTrue(user.is_verified)
+
+    def test_policies_are_cached(self):
+        get_directory_policy()
+        get_directory_policy(self.directory.href)
+
+        with self.assertNumStormpathCalls(0):
+            self.assertTrue(get_default_is_active())
+            self.assertTrue(get_directory_policy(self.directory.href).verification_required)
+
+
+class TestAccountSync(LiveTestBase):
+    def setUp(self):
+        super(TestAccountSync, self).setUp()
+        for i in range(5):
+            self.app.accounts.create({
+                'given_name': 'Given %d' % i,
+                'surname': 'Sur %d' % i,
+                'email': 'sync%d@example.com' % i,
+                'password': 'W00t123!W00t123!',
+            })
+
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.path)
+        self.checkpoint = Checkpoint(self.path)
+
+    def tearDown(self):
+        self.checkpoint.clear()
+        super(TestAccountSync, self).tearDown()
+
+    def test_sync_in_batches(self):
+        state = AccountSync(self.app, batch_size=2, checkpoint=self.checkpoint).run()
+
+        self.assertEqual(5, state['created'])
+        self.assertEqual(5, UserModel.objects.count())
+        # A complete sync leaves nothing to resume.
+        self.assertIsNone(self.checkpoint.load())
+
+    def test_dry_run_writes_nothing(self):
+        state = AccountSync(self.app, batch_size=2, dry_run=True).run()
+
+        self.assertEqual(5, state['created'])
+        self.assertEqual(0, UserModel.objects.count())
+
+    def test_sync_a_partition(self):
+        state = AccountSync(self.app, batch_size=2, start=1, end=4).run()
+
+        self.assertEqual(4, state['offset'])
+        self.assertEqual(3, UserModel.objects.count())
+
+    def test_users_of_other_accounts_are_not_taken_over(self):
+        AccountSync(self.app).run()
+        other = 'https://api.stormpath.com/v1/accounts/other'
+        UserModel.objects.filter(email='sync1@example.com').update(href=other)
+
+        state = AccountSync(self.app).run()
+
+        self.assertEqual(1, state['skipped'])
+        self.assertEqual(0, state['created'])
+        self.assertEqual(other, UserModel.objects.get(email='sync1@example.com').href)
+
+    def test_default_checkpoints_are_per_application(self):
+        other = CLIENT.applications.get(self.app.href.rsplit('/', 1)[0] + '/other')
+        self.assertNotEqual(get_default_checkpoint(self.app), get_default_checkpoint(other))
+        self.assertIn(self.app.href.rsplit('/', 1)[-1], get_default_checkpoint(self.app))
+
+    def test_backfill_hrefs(self):
+        AccountSync(self.app).run()
+        UserModel.objects.filter(email__in=['sync1@example.com', 'sync3@example.com']).update(href=None)
+
+        self.assertEqual(2, backfill_hrefs(self.app, batch_size=2))
+        self.assertFalse(UserModel.objects.filter(href=None).exists())
+        self.assertEqual(0, backfill_hrefs(self.app))
+
+    def test_checkpoints_of_other_partitions_are_not_resumed(self):
+        AccountSync(self.app, batch_size=2, start=0, end=3, limit=2,
+            checkpoint=self.checkpoint).run()
+        self.assertEqual(2, self.checkpoint.load()['offset'])
+
+        # Say the total changed, and the second partition now starts at 2.
+        state = AccountSync(self.app, batch_size=2, start=2, end=5,
+            checkpoint=self.checkpoint).run(resume=True)
+
+        self.assertEqual(5, state['offset'])
+        self.assertEqual(3, state['created'])
+
+    def test_partitions(self):
+        self.assertEqual([{'start': 0, 'end': 3}, {'start': 3, 'end': 5}],
+            get_partitions(self.app, 'range', 2))
+
+        stores = get_partitions(self.app, 'store', 2)
+        self.assertEqual([m.account_store.href for m in self.app.account_store_mappings],
+            [p['store'] for p in stores])
+
+    def test_partition_syncs_its_own_application(self):
+        # Not the default application of the process.
+        django_stormpath.models.APPLICATION = None
+
+        state = _sync_partition({
+            'application': self.app.href,
+            'start': 0,
+            'end': 5,
+            'options': {'sync_groups': False},
+            'resume': False,
+        })
+
+        self.assertEqual(5, state['accounts'])
+        self.assertEqual(5, UserModel.objects.count())
+
+    def test_resume_continues_from_checkpoint(self):
+        state = AccountSync(self.app, batch_size=2, limit=3, checkpoint=self.checkpoint).run()
+        self.assertEqual(3, state['offset'])
+        self.assertEqual(3, UserModel.objects.count())
+
+        state = AccountSync(self.app, batch_size=2, checkpoint=self.checkpoint).run(resume=True)
+
+        self.assertEqual(5, state['offset'])
+        self.assertEqual(5, state['created'])
+        self.assertEqual(0, state['updated'])
+        self.assertEqual(5, UserModel.objects.count())
+
+    def test_only_changed_users_are_written(self):
+        AccountSync(self.app).run()
+        UserModel.objects.filter(email='sync0@example.com').update(surname='Changed')
+
+        state = AccountSync(self.app).run()
+
+        self.assertEqual(0, state['created'])
+        self.assertEqual(1, state['updated'])
+        self.assertEqual(4, state['unchanged'])
+        self.assertEqual('Sur 0', UserModel.objects.get(email='sync0@example.com').surname)
+
+    def test_account_record(self):
+        record = AccountRecord({
+            'href': 'https://api.stormpath.com/v1/accounts/1',
+            'email': 'record@example.com',
+            'givenName': 'Given',
+            'status': 'ENABLED',
+            'customData': {'spDjango_is_staff': True, 'other': 'x'},
+            'groups': {'size': 2, 'items': [{'name': 'admins'}]},
+        }, UserModel.DJANGO_PREFIX)
+
+        self.assertEqual('Given', record['given_name'])
+        self.assertEqual({'spDjango_is_staff': True}, record.custom_data)
+        # Only one of the two groups was expanded.
+        self.assertIsNone(record.group_names)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+
+class LineCollector(object):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+class TestAccountPush(LiveTestBase):
+    def create_local_user(self, email):
+        user = UserModel(email=email, username=email, given_name='John', surname='Doe')
+        user.set_unusable_password()
+        user._save_db_only()
+        return user
+
+    def test_push_creates_accounts_and_saves_hrefs(self):
+        for i in range(5):
+            self.create_local_user('push%d@example.com' % i)
+
+        stats = UserModel.objects.push_accounts_to_stormpath(workers=2, chunk_size=2)
+
+        self.assertEqual(5, stats['pushed'])
+        self.assertEqual(0, UserModel.objects.filter(href__isnull=True).count())
+        for user in UserModel.objects.all():
+            self.assertEqual(user.email, self.app.accounts.get(user.href).email)
+
+    def test_failures_are_recorded_and_left_for_later(self):
+        self.create_local_user('push@example.com')
+        bad = self.create_local_user('not an email')
+        failures = LineCollector()
+
+        stats = UserModel.objects.push_accounts_to_stormpath(failures=failures)
+
+        self.assertEqual(1, stats['pushed'])
+        self.assertEqual(1, stats['failed'])
+        self.assertIsNone(UserModel.objects.get(pk=bad.pk).href)
+        self.assertEqual(bad.pk, json.loads(failures.lines[0])['pk'])
+
+    def test_only_bcrypt_hashes_are_imported(self):
+        self.assertEqual('$2b$12$abc', get_importable_password('bcrypt$$2b$12$abc'))
+        self.assertIsNone(get_importable_password('pbkdf2_sha256$36000$salt$hash'))
+        self.assertIsNone(get_importable_password('!unusable'))
+
+
+class TestMirrorExportImport(TestCase):
+    def setUp(self):
+        Group.objects.bulk_create([Group(name='admins'), Group(name='users')])
+        for i in range(3):
+            user = UserModel(email='mirror%d@example.com' % i, username='mirror%d@example.com' % i,
+                given_name='John', surname='Doe %d' % i, is_staff=bool(i % 2),
+                href='https://api.stormpath.com/v1/accounts/%d' % i)
+            user.set_unusable_password()
+            user._save_db_only()
+            user.groups = Group.objects.filter(name__in=['users'] if i else ['admins', 'users'])
+
+    def snapshot(self):
+        return sorted(
+            (u.href, u.email, u.surname, u.is_staff, tuple(sorted(g.name for g in u.groups.all())))
+            for u in UserModel.objects.all())
+
+    def test_round_trip(self):
+        before = self.snapshot()
+        stream = io.StringIO()
+        self.assertEqual(3, export_mirror(stream, chunk_size=2))
+
+        UserModel.objects.all().delete()
+        stream.seek(0)
+        self.assertEqual(3, import_mirror(stream, chunk_size=2))
+
+        self.assertEqual(before, self.snapshot())
+
+    def test_import_updates_existing_users(self):
+        stream = io.StringIO()
+        export_mirror(stream)
+        UserModel.objects.filter(email='mirror0@example.com').update(surname='Changed')
+        UserModel.objects.get(email='mirror0@example.com').groups.clear()
+
+        stream.seek(0)
+        import_mirror(stream)
+
+        user = UserModel.objects.get(email='mirror0@example.com')
+        self.assertEqual('Doe 0', user.surname)
+        self.assertEqual(['admins', 'users'], sorted(g.name for g in user.groups.all()))
+        self.assertEqual(3, UserModel.objects.count())
+
+    def test_last_duplicate_row_wins(self):
+        stream = io.StringIO()
+        export_mirror(stream)
+        UserModel.objects.all().delete()
+
+        rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+        changed = dict(rows[0], surname='Changed')
+        lines = [json.dumps(r) for r in rows + [changed]]
+        self.assertEqual(4, import_mirror(io.StringIO(u'\n'.join(lines)), chunk_size=10))
+
+        self.assertEqual(3, UserModel.objects.count())
+        self.assertEqual('Changed', UserModel.objects.get(email=rows[0]['email']).surname)
+
+    def test_gzip_files(self):
+        fd, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        try:
+            with open_mirror(path, 'w') as stream:
+                export_mirror(stream)
+            with open_mirror(path) as stream:
+                self.assertEqual(3, len(stream.readlines()))
+        finally:
+            os.remove(path)
+
+
+class TestReconciler(LiveTestBase):
+    def setUp(self):
+        super(TestReconciler, self).setUp()
+        self.users = [self.create_django_user(email='reconcile%d@example.com' % i) for i in range(5)]
+        self.drift = []
+
+    def reconcile(self, **kwargs):
+        return Reconciler(self.app, batch_size=2,
+            report=lambda *args: self.drift.append(args), **kwargs).run()
+
+    def test_nothing_to_report_when_in_sync(self):
+        stats = self.reconcile()
+
+        self.assertEqual(5, stats['accounts'])
+        self.assertEqual(0, stats['mismatched_batches'])
+        self.assertEqual([], self.drift)
+
+    def test_drift_is_reported(self):
+        UserModel.objects.filter(pk=self.users[1].pk).update(surname='Changed', is_staff=True)
+        self.app.accounts.get(self.users[3].href).delete()
+        account = self.app.accounts.create({
+            'given_name': 'New',
+            'surname': 'User',
+            'email': 'reconcile9@example.com',
+            'password': 'W00t123!W00t123!',
+        })
+
+        stats = self.reconcile()
+
+        self.assertEqual(1, stats['different'])
+        self.assertEqual(1, stats['missing_remotely'])
+        self.assertEqual(1, stats['missing_locally'])
+        self.assertIn(('different', self.users[1].href, self.users[1].email,
+            ['spDjango_is_staff', 'surname']), self.drift)
+        self.assertIn(('missing_locally', account.href, account.email, []), self.drift)
+
+    def test_accounts_without_custom_data_converge(self):
+        # As created by ID Site, social login or the console.
+        self.app.accounts.create({
+            'given_name': 'Plain',
+            'surname': 'Account',
+            'email': 'reconcile9@example.com',
+            'password': 'W00t123!W00t123!',
+        })
+
+        self.reconcile(repair=True)
+        self.drift = []
+        self.assertEqual(0, self.reconcile()['different'])
+        self.assertEqual([], self.drift)
+
+    def test_disabled_accounts_converge(self):
+        account = self.app.accounts.get(self.users[1].href)
+        account.status = account.STATUS_DISABLED
+        account.save()
+
+        self.reconcile(repair=True)
+        self.assertFalse(UserModel.objects.get(pk=self.users[1].pk).is_active)
+        self.drift = []
+        self.assertEqual(0, self.reconcile()['different'])
+        self.assertEqual([], self.drift)
+
+    def test_verification_is_not_compared(self):
+        # is_verified is derived from the directory's policy when mirroring,
+        # whatever the account's custom data says.
+        UserModel.objects.filter(pk=self.users[1].pk).update(is_verified=True)
+        UserModel.objects.filter(pk=self.users[2].pk).update(is_verified=False)
+
+        self.assertEqual(0, self.reconcile()['different'])
+
+    def test_repair_updates_local_users(self):
+        UserModel.objects.filter(pk=self.users[1].pk).update(surname='Changed')
+
+        self.reconcile(repair=True)
+
+        self.assertEqual(self.users[1].surname, UserModel.objects.get(pk=self.users[1].pk).surname)
+        self.drift = []
+        self.assertEqual(0, self.reconcile()['different'])
+
+
+class TestTenants(LiveTestBase):
+    def setUp(self):
+        super(TestTenants, self).setUp()
+        self.other = CLIENT.applications.create({'name': self.prefix + '-other'},
+            create_directory=True)
+
+    def tearDown(self):
+        for mapping in self.other.account_store_mappings:
+            mapping.account_store.delete()
+        self.other.delete()
+
+        super(TestTenants, self).tearDown()
+
+    def test_pool_evicts_least_recently_used(self):
+        pool = ApplicationPool(size=2)
+        application = pool.get(self.app.href)
+        pool.get(self.other.href)
+        pool.get(self.app.href)
+        pool.get(self.app.href + '-unknown')
+
+        self.assertEqual(2, len(pool))
+        self.assertIs(application, pool.get(self.app.href))
+
+    def test_middleware_resolves_the_tenant_by_host(self):
+        middleware = StormpathTenantMiddleware()
+        with self.settings(ALLOWED_HOSTS=['*'],
+                STORMPATH_TENANT_APPLICATIONS={'other.example.com': self.other.href}):
+            request = RequestFactory().get('/', HTTP_HOST='other.example.com:8000')
+            middleware.process_request(request)
+            self.assertEqual(self.other.href, request.stormpath_application.href)
+            self.assertEqual(self.other.href, get_application().href)
+            middleware.process_response(request, None)
+            self.assertEqual(self.app.href, get_application().href)
+
+            request = RequestFactory().get('/', HTTP_HOST='www.example.com')
+            middleware.process_request(request)
+            self.assertEqual(self.app.href, request.stormpath_application.href)
+            middleware.process_response(request, None)
+
+    def test_users_are_created_in_the_tenant_application(self):
+        with tenant(self.other.href):
+            self.create_django_user(email='tenant@example.com')
+
+        self.assertEqual(1, len(self.other.accounts.search({'email': 'tenant@example.com'})))
+        self.assertEqual(0, len(self.app.accounts.search({'email': 'tenant@example.com'})))
+
+    def test_users_of_other_accounts_are_not_taken_over(self):
+        user = self.create_django_user(superuser=True, email='shared@example.com',
+            password='W00t123!W00t123!')
+        self.other.accounts.create({
+            'given_name': 'Other',
+            'surname': 'Tenant',
+            'email': 'shared@example.com',
+            'password': 'W00t123!W00t123!',
+        })
+
+        with tenant(self.other.href):
+            self.assertIsNone(StormpathBackend().authenticate(
+                'shared@example.com', 'W00t123!W00t123!'))
+
+        self.assertEqual(user.href, UserModel.objects.get(email='shared@example.com').href)
+
+    def test_groups_are_per_tenant(self):
+        prefix = get_group_prefix(self.other)
+        self.assertEqual('', get_group_prefix(self.app))
+        self.assertTrue(prefix.endswith(':'))
+        self.assertEqual('admins', remote_group_name(local_group_name('admins', self.other), self.other))
+        self.assertIsNone(remote_group_name('admins', self.other))
+
+        Group.objects.create(name='admins')
+        group = self.other.groups.create({'name': 'admins'})
+        account = self.other.accounts.create({
+            'given_name': 'Other',
+            'surname': 'Tenant',
+            'email': 'grouped@example.com',
+            'password': 'W00t123!W00t123!',
+        })
+        account.add_group(group)
+
+        with tenant(self.other.href):
+            user = StormpathBackend().authenticate('grouped@example.com', 'W00t123!W00t123!')
+
+        self.assertEqual([prefix + 'admins'], [g.name for g in user.groups.all()])
+
+    def test_push_creates_accounts_in_the_tenant_application(self):
+        user = UserModel(email='pushed@example.com', username='pushed@example.com',
+            given_name='John', surname='Doe')
+        user.set_unusable_password()
+        user._save_db_only()
+
+        with tenant(self.other.href):
+            self.assertEqual(1, AccountPush(workers=2).run()['pushed'])
+
+        self.assertEqual(1, len(self.other.accounts.search({'email': 'pushed@example.com'})))
+        self.assertEqual(0, len(self.app.accounts.search({'email': 'pushed@example.com'})))